@@ -1,20 +1,206 @@
+import os
+import re
+import json
+import time
+from collections import OrderedDict
+from threading import Lock
 import google.generativeai as genai
 
 # INSERT YOUR API KEY BELOW
 genai.configure(api_key="")
-model = genai.GenerativeModel("gemini-1.5-flash")
+
+class LLMBackend:
+    """
+    Interface of the text generation backends. Subclasses implement generate(), and stream()
+    if the backend can return partial answers (by default the full answer is one delta).
+    The name identifies the model in the response cache.
+    """
+    name = "llm"
+
+    def generate(self, prompt: str) -> str:
+        raise NotImplementedError
+
+    def stream(self, prompt: str):
+        yield self.generate(prompt)
+
+class GeminiBackend(LLMBackend):
+    """
+    Google Gemini through google.generativeai (default backend)
+    """
+    def __init__(self, model_name: str = "gemini-1.5-flash"):
+        self.name = model_name
+        self.model = genai.GenerativeModel(model_name)
+
+    def generate(self, prompt: str) -> str:
+        response = self.model.generate_content(prompt)
+        print(response)
+        return response.text
+
+    def stream(self, prompt: str):
+        for chunk in self.model.generate_content(prompt, stream=True):
+            yield chunk.text
+
+class CannedBackend(LLMBackend):
+    """
+    Offline stand-in returning a fixed answer, for running the pipeline without an API key
+    """
+    name = "canned"
+
+    def __init__(self, answer: str = "Hello! I am Chatty. How are you feeling today?"):
+        self.answer = answer
+
+    def generate(self, prompt: str) -> str:
+        return self.answer
+
+class ResponseCache:
+    """
+    Persistent LRU cache with expiry, stored as JSON. Keys are strings (see cache_key),
+    values anything JSON serializable. Keeps hit/miss counters for the current process.
+    """
+    def __init__(self, path: str, max_entries: int = 256, ttl: float = 7 * 24 * 3600, on_evict=None):
+        """
+        @param path: str -> JSON file the cache is loaded from and saved to
+        @param max_entries: int -> least recently used entries beyond this are evicted
+        @param ttl: float -> seconds after which an entry expires (None: never)
+        @param on_evict: callable -> called with the value of every evicted or expired entry
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.entries = OrderedDict((key, tuple(entry)) for key, entry in json.load(f))
+
+    def get(self, key: str):
+        """
+        @return: the cached value, or None on a miss
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and time.time() - entry[0] > self.ttl:
+                self._evict(key)
+                self._save()
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: str, value):
+        with self.lock:
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self._evict(next(iter(self.entries)))
+            self._save()
+
+    def _evict(self, key: str):
+        _, value = self.entries.pop(key)
+        if self.on_evict is not None:
+            self.on_evict(value)
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(list(self.entries.items()), f)
+        os.replace(self.path + ".tmp", self.path)
+
+backend = GeminiBackend()
+response_cache = ResponseCache("temp/llm_cache.json")
+
+def set_backend(new_backend: LLMBackend):
+    """
+    @param new_backend: LLMBackend -> backend used by all following requests, e.g. a client for
+    a local stub server or an offline model
+    """
+    global backend
+    backend = new_backend
+
+def cache_key(prompt: str, emotion: str, model_name: str = None) -> str:
+    """
+    @return: str -> key of a turn in the response caches: the model name, the emotion and the
+    prompt, lowercased, with collapsed whitespace and without surrounding punctuation
+    """
+    if model_name is None:
+        model_name = backend.name
+    normalized = re.sub(r"\s+", " ", prompt.lower()).strip(" .!?,;:")
+    return f"{model_name}|{emotion.lower()}|{normalized}"
+
+def build_prompt(prompt: str, emotion: str) -> str:
+    """
+    Adds the length limit and the detected emotion to the user input
+    """
+    return prompt + f" | request: keep the answer between 10 and 30 words! | Take into account that user is in emotion {emotion}"
+
 def generate_response(prompt: str, emotion: str) -> str:
     """
     @param prompt: str -> This parameter is the textual user input (or transscribed audio)
     @param emotion: str -> This parameter is the emotion detected either in text or speech
 
-    @return: str -> The return value of this function is the textual response of the LLM for 
+    @return: str -> The return value of this function is the textual response of the LLM for
     the user.
 
-    Description: This function takes the user input, adds the some part between the | and then returns the textual response. 
+    Description: This function takes the user input, adds the some part between the | and then returns the textual response.
     The length of this is limitted to 10-30 words, to not significantly impact performance by too long responses.
+    Answers are cached in response_cache, so repeated prompts skip the round trip.
+    """
+    key = cache_key(prompt, emotion)
+    response = response_cache.get(key)
+    if response is None:
+        response = backend.generate(build_prompt(prompt, emotion))
+        response_cache.put(key, response)
+    return response
+
+def stream_response(prompt: str, emotion: str):
+    """
+    @param prompt: str -> textual user input (or transscribed audio)
+    @param emotion: str -> emotion detected either in text or speech
+
+    @return: generator -> the text deltas of the response, as the backend streams them
+
+    Description: Streaming variant of generate_response. A cached answer is yielded as a single delta.
+    """
+    key = cache_key(prompt, emotion)
+    response = response_cache.get(key)
+    if response is not None:
+        yield response
+        return
+    response = ""
+    for delta in backend.stream(build_prompt(prompt, emotion)):
+        response += delta
+        yield delta
+    response_cache.put(key, response)
+
+def stream_sentences(prompt: str, emotion: str):
+    """
+    @param prompt: str -> textual user input (or transscribed audio)
+    @param emotion: str -> emotion detected either in text or speech
+
+    @return: generator -> the complete sentences of the response, each one as soon as it is finished
+
+    Description: Buffers the deltas of stream_response and cuts them into sentences, so speech
+    synthesis can start on the first sentence while the rest of the answer is still generated.
+    """
+    pending = ""
+    for delta in stream_response(prompt, emotion):
+        pending += delta
+        # Everything up to the last sentence end followed by whitespace is complete
+        ends = list(re.finditer(r"[.!?]\s+", pending))
+        if ends:
+            complete, pending = pending[:ends[-1].end()], pending[ends[-1].end():]
+            yield from split_sentences(complete)
+    if pending.strip():
+        yield pending.strip()
+
+def split_sentences(text: str) -> list:
+    """
+    Splits a text into sentences, on ., ! and ? followed by whitespace
     """
-    response = model.generate_content(prompt + f" | request: keep the answer between 10 and 30 words! | Take into account that user is in emotion {emotion}")
-    print(response)
-    return response.text
-    
+    return [sentence for sentence in re.split(r"(?<=[.!?])\s+", text.strip()) if sentence]
@@ -1,6 +1,7 @@
 import librosa
 import librosa.filters
 import numpy as np
+import torch
 # import tensorflow as tf
 from scipy import signal
 from scipy.io import wavfile
@@ -44,21 +45,100 @@ def linearspectrogram(wav):
 
 def melspectrogram(wav):
     D = _stft(preemphasis(wav, hp.preemphasis, hp.preemphasize))
-    S = _amp_to_db(_linear_to_mel(np.abs(D))) - hp.ref_level_db
+    return _magnitude_to_mel(np.abs(D))
+
+def _magnitude_to_mel(M):
+    S = _amp_to_db(_linear_to_mel(M)) - hp.ref_level_db
     
     if hp.signal_normalization:
         return _normalize(S)
     return S
 
+class MelStream:
+    """Incremental melspectrogram.
+
+    Feed successive chunks of a waveform to feed() and call finish() after the last one.
+    The preemphasis filter state and the samples of partially covered STFT frames are
+    kept between calls, so the concatenated outputs equal melspectrogram() of the whole
+    waveform. Only the librosa STFT (use_lws=False) is supported, padded with
+    hparams.stft_pad_mode like _stft (reflect or constant).
+    """
+    def __init__(self):
+        assert not hp.use_lws, 'MelStream requires use_lws=False'
+        self.n_fft = hp.n_fft
+        self.hop_size = get_hop_size()
+        self.pad = self.n_fft // 2
+        self.pad_mode = hp.stft_pad_mode
+        assert self.pad_mode in ('reflect', 'constant'), 'Unsupported stft_pad_mode {}'.format(self.pad_mode)
+        window = signal.get_window('hann', hp.win_size or self.n_fft, fftbins=True)
+        self.window = librosa.util.pad_center(window, size=self.n_fft)[:, None]
+        self.zi = np.zeros(1)
+        # Preemphasized samples from the start of the next frame on (centered, i.e. padded)
+        self.buffer = np.zeros(0)
+        # Last pad + 1 preemphasized samples, reflected at the end by finish()
+        self.tail = np.zeros(0)
+        self.started = False
+        self.finished = False
+
+    def feed(self, wav):
+        """Returns the mel frames (num_mels, T) completed by this chunk, possibly none"""
+        assert not self.finished, 'MelStream is already finished'
+        wav = np.asarray(wav)
+        if len(wav) == 0:
+            return np.zeros((hp.num_mels, 0))
+        y = self._preemphasis(wav)
+        self.buffer = np.concatenate([self.buffer, y])
+        self.tail = np.concatenate([self.tail, y])[-(self.pad + 1):]
+        if not self.started:
+            if self.pad_mode == 'constant':
+                self.buffer = np.concatenate([np.zeros(self.pad), self.buffer])
+            else:
+                # The reflect padding at the start needs the first pad + 1 samples
+                if len(self.buffer) <= self.pad:
+                    return np.zeros((hp.num_mels, 0))
+                self.buffer = np.concatenate([self.buffer[self.pad:0:-1], self.buffer])
+            self.started = True
+        return self._frames()
+
+    def finish(self):
+        """Returns the remaining mel frames, which depend on the padding at the end of the waveform"""
+        assert not self.finished, 'MelStream is already finished'
+        self.finished = True
+        if not self.started:
+            self.buffer = np.pad(self.buffer, self.pad, mode=self.pad_mode)
+        elif self.pad_mode == 'constant':
+            self.buffer = np.concatenate([self.buffer, np.zeros(self.pad)])
+        else:
+            self.buffer = np.concatenate([self.buffer, self.tail[-2::-1][:self.pad]])
+        return self._frames()
+
+    def _preemphasis(self, wav):
+        if not hp.preemphasize:
+            return wav
+        y, self.zi = signal.lfilter([1, -hp.preemphasis], [1], wav, zi=self.zi)
+        return y
+
+    def _frames(self):
+        count = 1 + (len(self.buffer) - self.n_fft) // self.hop_size if len(self.buffer) >= self.n_fft else 0
+        if count == 0:
+            return np.zeros((hp.num_mels, 0))
+        frames = librosa.util.frame(np.ascontiguousarray(self.buffer[:(count - 1) * self.hop_size + self.n_fft]),
+                                    frame_length=self.n_fft, hop_length=self.hop_size)
+        self.buffer = self.buffer[count * self.hop_size:]
+        # Same precision as librosa.stft
+        D = np.fft.rfft(self.window * frames, axis=0).astype(np.complex64)
+        return _magnitude_to_mel(np.abs(D))
+
 def _lws_processor():
     import lws
     return lws.lws(hp.n_fft, get_hop_size(), fftsize=hp.win_size, mode="speech")
 
 def _stft(y):
     if hp.use_lws:
-        return _lws_processor(hp).stft(y).T
+        return _lws_processor().stft(y).T
     else:
-        return librosa.stft(y=y, n_fft=hp.n_fft, hop_length=get_hop_size(), win_length=hp.win_size)
+        return librosa.stft(y=y, n_fft=hp.n_fft, hop_length=get_hop_size(), win_length=hp.win_size, 
+                            pad_mode=hp.stft_pad_mode)
 
 ##########################################################
 #Those are only correct when using lws!!! (This was messing with Wavenet quality for a long time!)
@@ -97,7 +177,7 @@ def _linear_to_mel(spectogram):
 
 def _build_mel_basis():
     assert hp.fmax <= hp.sample_rate // 2
-    return librosa.filters.mel(hp.sample_rate, hp.n_fft, n_mels=hp.num_mels,
+    return librosa.filters.mel(sr=hp.sample_rate, n_fft=hp.n_fft, n_mels=hp.num_mels,
                                fmin=hp.fmin, fmax=hp.fmax)
 
 def _amp_to_db(x):
@@ -134,3 +214,96 @@ def _denormalize(D):
         return (((D + hp.max_abs_value) * -hp.min_level_db / (2 * hp.max_abs_value)) + hp.min_level_db)
     else:
         return ((D * -hp.min_level_db / hp.max_abs_value) + hp.min_level_db)
+
+##########################################################
+# Batched torch front-end, equivalent to linearspectrogram/melspectrogram (use_lws=False)
+# within float32 precision. Waveforms are the rows of a zero padded (B, T) array or tensor.
+_torch_constants = {}
+
+def linearspectrogram_batch(wavs, lengths=None, device=None):
+    """Returns the (B, n_fft // 2 + 1, T) spectrograms and the number of valid frames of each row"""
+    M, num_frames = _torch_stft_magnitude(wavs, lengths, device)
+    return _torch_finish(_torch_amp_to_db(M), num_frames)
+
+def melspectrogram_batch(wavs, lengths=None, device=None):
+    """Returns the (B, num_mels, T) mel spectrograms and the number of valid frames of each row"""
+    M, num_frames = _torch_stft_magnitude(wavs, lengths, device)
+    _, mel_basis = _get_torch_constants(M.device)
+    return _torch_finish(_torch_amp_to_db(torch.matmul(mel_basis, M)), num_frames)
+
+def _get_torch_constants(device):
+    """Window and mel basis tensors, built once per device"""
+    key = str(device)
+    if key not in _torch_constants:
+        global _mel_basis
+        if _mel_basis is None:
+            _mel_basis = _build_mel_basis()
+        window = signal.get_window('hann', hp.win_size or hp.n_fft, fftbins=True)
+        window = librosa.util.pad_center(window, size=hp.n_fft)
+        _torch_constants[key] = (torch.tensor(window, dtype=torch.float32, device=device),
+                                 torch.tensor(_mel_basis, dtype=torch.float32, device=device))
+    return _torch_constants[key]
+
+def _reflect_indices(length, pad, device):
+    """Indices of a waveform of the given length, reflect padded by pad samples at both ends. Like
+    np.pad, the reflection repeats when the waveform is shorter than pad, which torch rejects."""
+    idx = torch.arange(-pad, length + pad, device=device)
+    if length == 1:
+        return torch.zeros_like(idx)
+    period = 2 * (length - 1)
+    idx = idx.remainder(period)
+    return torch.where(idx >= length, period - idx, idx)
+
+def _torch_stft_magnitude(wavs, lengths, device):
+    wavs = torch.as_tensor(wavs, dtype=torch.float32, device=device)
+    if wavs.dim() == 1:
+        wavs = wavs[None]
+    if lengths is None:
+        lengths = [wavs.shape[1]] * len(wavs)
+    lengths = [int(length) for length in lengths]
+    window, _ = _get_torch_constants(wavs.device)
+    hop_size = get_hop_size()
+    pad = hp.n_fft // 2
+
+    if hp.preemphasize:
+        wavs = torch.cat([wavs[:, :1], wavs[:, 1:] - hp.preemphasis * wavs[:, :-1]], dim=1)
+
+    # Center every waveform like _stft, padding it at its own end, not at the end of the batch
+    padded = wavs.new_zeros((len(wavs), max(lengths) + 2 * pad))
+    if hp.stft_pad_mode == 'reflect':
+        # Empty rows stay silent, their single frame is all zeros
+        for i, length in enumerate(lengths):
+            if length > 0:
+                padded[i, :length + 2 * pad] = wavs[i, _reflect_indices(length, pad, wavs.device)]
+    else:
+        assert hp.stft_pad_mode == 'constant', 'Unsupported stft_pad_mode {}'.format(hp.stft_pad_mode)
+        for i, length in enumerate(lengths):
+            padded[i, pad:length + pad] = wavs[i, :length]
+
+    D = torch.stft(padded, hp.n_fft, hop_length=hop_size, win_length=hp.n_fft, window=window,
+                   center=False, return_complex=True)
+    num_frames = torch.tensor([1 + length // hop_size for length in lengths], device=wavs.device)
+    return D.abs(), num_frames
+
+def _torch_amp_to_db(x):
+    min_level = np.exp(hp.min_level_db / 20 * np.log(10))
+    return 20 * torch.log10(torch.clamp(x, min=min_level))
+
+def _torch_normalize(S):
+    if hp.symmetric_mels:
+        S = (2 * hp.max_abs_value) * ((S - hp.min_level_db) / (-hp.min_level_db)) - hp.max_abs_value
+        low = -hp.max_abs_value
+    else:
+        S = hp.max_abs_value * ((S - hp.min_level_db) / (-hp.min_level_db))
+        low = 0
+    if hp.allow_clipping_in_normalization:
+        return torch.clamp(S, low, hp.max_abs_value)
+    return S
+
+def _torch_finish(S, num_frames):
+    S = S - hp.ref_level_db
+    if hp.signal_normalization:
+        S = _torch_normalize(S)
+    # Zero the frames past the end of the shorter waveforms
+    valid = torch.arange(S.shape[-1], device=S.device)[None] < num_frames[:, None]
+    return S * valid[:, None], num_frames
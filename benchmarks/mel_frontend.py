@@ -0,0 +1,58 @@
+"""Compares the librosa mel front-end (audio.melspectrogram, one waveform at a time)
+with the batched torch one (audio.melspectrogram_batch).
+
+	python benchmarks/mel_frontend.py --batch_size 16 --seconds 10 --device cuda
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import audio
+from hparams import hparams as hp
+
+parser = argparse.ArgumentParser(description='Benchmark of the librosa and torch mel front-ends')
+parser.add_argument('--batch_size', type=int, default=16, help='Waveforms per batch')
+parser.add_argument('--seconds', type=float, default=10., help='Length of the longest waveform')
+parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+parser.add_argument('--repeat', type=int, default=5, help='Timed runs, the best one is reported')
+args = parser.parse_args()
+
+def best_of(fn):
+	fn()  # Warm up (mel basis, window, cuda context)
+	times = []
+	for _ in range(args.repeat):
+		start = time.perf_counter()
+		fn()
+		if args.device.startswith('cuda'):
+			torch.cuda.synchronize()
+		times.append(time.perf_counter() - start)
+	return min(times)
+
+def main():
+	rng = np.random.RandomState(0)
+	max_length = int(args.seconds * hp.sample_rate)
+	lengths = rng.randint(max_length // 2, max_length + 1, size=args.batch_size)
+	wavs = np.zeros((args.batch_size, max_length), dtype=np.float32)
+	for i, length in enumerate(lengths):
+		wavs[i, :length] = 0.1 * rng.randn(length)
+
+	librosa_time = best_of(lambda: [audio.melspectrogram(wav[:length]) for wav, length in zip(wavs, lengths)])
+	torch_time = best_of(lambda: audio.melspectrogram_batch(wavs, lengths, device=args.device))
+
+	S, num_frames = audio.melspectrogram_batch(wavs, lengths, device=args.device)
+	error = max(np.abs(S[i, :, :num_frames[i]].cpu().numpy() - audio.melspectrogram(wavs[i, :length])).max()
+				for i, length in enumerate(lengths))
+
+	audio_seconds = lengths.sum() / float(hp.sample_rate)
+	print('{} waveforms, {:.1f} s of audio'.format(args.batch_size, audio_seconds))
+	print('librosa: {:.4f} s ({:.0f}x real time)'.format(librosa_time, audio_seconds / librosa_time))
+	print('torch ({}): {:.4f} s ({:.0f}x real time)'.format(args.device, torch_time, audio_seconds / torch_time))
+	print('max abs difference: {:.2e}'.format(error))
+
+if __name__ == '__main__':
+	main()
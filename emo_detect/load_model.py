@@ -6,43 +6,96 @@ import librosa
 import numpy as np
 import torch.nn.functional as F
 
-def predict(file):
+class EmotionPredictor:
     """
-    @param file: wav file to read
-    -> returns emotion recognized from wav-file
+    Keeps the audio emotion model loaded between predictions, so each recording
+    only costs the feature extraction and one forward pass.
     """
+    # Define your label mapping
+    emo_dict = {0: 'Angry', 1: 'Happy', 2: 'Neutral', 3: 'Sad', 4: 'Surprise'}
+    max_width = 32  # Adjust to match the expected input shape
 
-    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
-    model = EmotionRecognitionModel(num_classes=5).to(device)
-    model.load_state_dict(torch.load(os.getcwd() + "/emo_detect/best_emotion_model.pth", weights_only=True))
+    def __init__(self, model_path=None, device=None):
+        """
+        @param model_path: state dict of the EmotionRecognitionModel (default: emo_detect/best_emotion_model.pth)
+        @param device: torch device (default: cuda if available)
+        """
+        if model_path is None:
+            model_path = os.getcwd() + "/emo_detect/best_emotion_model.pth"
+        if device is None:
+            device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+        self.device = device
+        self.model = EmotionRecognitionModel(num_classes=5).to(device)
+        self.model.load_state_dict(torch.load(model_path, map_location=device, weights_only=True))
+        self.model.eval()
 
-    vec = extract_log_mel_spectrogram(file)
-    model.eval()
-    log_mel_spec = torch.tensor(vec, dtype=torch.float32).unsqueeze(0).unsqueeze(0).to(device)  # Add batch and channel dims
-    print(log_mel_spec.shape)
-    max_width = 32  # Adjust to match the expected input shape
-    if max_width is not None:
-        log_mel_spec = _pad_or_truncate(log_mel_spec, max_width)
+    def features(self, signal, sr=22050):
+        """
+        @param signal: mono audio as a numpy array
+        @param sr: sampling rate of signal
+        -> returns the padded/truncated log-mel input of the model, shape (1, 128, max_width)
+        """
+        vec = log_mel_spectrogram(signal, sr)
+        log_mel_spec = torch.tensor(vec, dtype=torch.float32).unsqueeze(0).unsqueeze(0)  # Add batch and channel dims
+        return _pad_or_truncate(log_mel_spec, self.max_width)[0]
+
+    def predict(self, signal, sr=22050):
+        """
+        @param signal: mono audio as a numpy array
+        @param sr: sampling rate of signal
+        -> returns emotion recognized from the audio
+        """
+        return self.predict_many([signal], sr)[0]
+
+    def predict_many(self, signals, sr=22050):
+        """
+        @param signals: list of mono audio clips as numpy arrays, all sampled at sr
+        @param sr: sampling rate of the clips
+        -> returns the emotion recognized in each clip, scored in a single forward pass
+        """
+        batch = torch.stack([self.features(signal, sr) for signal in signals]).to(self.device)
+        with torch.no_grad():
+            probabilities = F.softmax(self.model(batch), dim=1)
+            # Get the index of the highest probability
+            predicted_idxs = torch.argmax(probabilities, dim=1).tolist()
+
+        # Map the predicted indexes to the corresponding labels
+        predicted_labels = [self.emo_dict[idx] for idx in predicted_idxs]
+        print(predicted_labels)
+        return predicted_labels
 
-    with torch.no_grad():
-        pred = model(log_mel_spec)
-        print(pred)
-        probabilities = F.softmax(pred, dim=1)
-        print(probabilities)
-        # Get the index of the highest probability
-        predicted_class_idx = torch.argmax(probabilities, dim=1).item()
+# Created on first use by get_predictor
+predictor = None
 
-        # Define your label mapping
-        emo_dict = {0: 'Angry', 1: 'Happy', 2: 'Neutral', 3: 'Sad', 4: 'Surprise'}
+def get_predictor():
+    """
+    -> returns the shared EmotionPredictor, loading the model on the first call
+    """
+    global predictor
+    if predictor is None:
+        predictor = EmotionPredictor()
+    return predictor
 
-        # Map the predicted index to the corresponding label
-        predicted_label = emo_dict[predicted_class_idx]
-        print(predicted_label)
-    return predicted_label
+def predict(file):
+    """
+    @param file: wav file to read
+    -> returns emotion recognized from wav-file
+    """
+    signal, sr = librosa.load(file, sr=22050, duration=3)
+    return get_predictor().predict(signal, sr)
 
 def extract_log_mel_spectrogram(audio_path, n_mels=128, duration=3, sr=22050):
     """Extracts the spectrogram of a given .wav file"""
     signal, sr = librosa.load(audio_path, sr=sr, duration=duration)
+    return log_mel_spectrogram(signal, sr, n_mels=n_mels, duration=duration, target_sr=sr)
+
+def log_mel_spectrogram(signal, sr, n_mels=128, duration=3, target_sr=22050):
+    """Extracts the spectrogram of the first duration seconds of an audio array"""
+    signal = np.asarray(signal, dtype=np.float32)
+    if sr != target_sr:
+        signal = librosa.resample(signal[:int(duration * sr)], orig_sr=sr, target_sr=target_sr)
+        sr = target_sr
+    signal = signal[:int(duration * sr)]
     mel_spec = librosa.feature.melspectrogram(y=signal, sr=sr, n_mels=n_mels, fmax=8000)
     log_mel_spec = librosa.power_to_db(mel_spec, ref=np.max)
     return log_mel_spec
@@ -56,4 +109,4 @@ def _pad_or_truncate(spec, max_width):
     else:
         # Truncate along the time dimension
         spec = spec[:, :, :, :max_width]
-    return spec
\ No newline at end of file
+    return spec
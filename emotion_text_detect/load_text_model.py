@@ -1,6 +1,6 @@
 import os
 os.environ['KMP_DUPLICATE_LIB_OK'] = 'TRUE'
-from gensim.models import Word2Vec
+from gensim.models import Word2Vec, KeyedVectors
 import torch
 import numpy as np
 from emotion_text_detect.SimpleNN import SimpleNN
@@ -8,9 +8,14 @@ import torch.nn.functional as F
 working_directory = os.getcwd()
 torch.serialization.add_safe_globals({'SimpleNN': SimpleNN})
 
+word2vec_path = working_directory+'/emotion_text_detect/word2vec.model'
+# Word vectors only (no training state), saved once from word2vec.model so they can be memory-mapped
+keyed_vectors_path = working_directory+'/emotion_text_detect/word2vec.kv'
+checkpoint_path = working_directory+'/emotion_text_detect/best_model.pth.tar'
 
-# Load pretrained Word2Vec model for input transformation
-word2vec_model = Word2Vec.load(working_directory+'/emotion_text_detect/word2vec.model')
+# Loaded on first use by get_word_vectors / get_model
+word_vectors = None
+model = None
 
 
 def load_checkpoint(filepath):
@@ -26,25 +31,50 @@ def load_checkpoint(filepath):
     best_loss = checkpoint['best_loss']
     
     return model, optimizer, epoch, best_loss
-model, optimizer, start_epoch, best_loss = load_checkpoint(working_directory+'/emotion_text_detect/best_model.pth.tar')
 
-def sentence_to_vector(sentence, model):
+def load_inference_model(filepath):
+    """Loads only the weights of a checkpoint for inference, without restoring the optimizer"""
+    checkpoint = torch.load(filepath, map_location='cpu', weights_only=True)
+    model = SimpleNN(100, 128, 3, 6)
+    model.load_state_dict(checkpoint['state_dict'])
+    return model.eval()
+
+def get_word_vectors():
+    """
+    Returns the memory-mapped Word2Vec vectors, exporting them from the full model on first use.
+    """
+    global word_vectors
+    if word_vectors is None:
+        if not os.path.isfile(keyed_vectors_path):
+            Word2Vec.load(word2vec_path).wv.save(keyed_vectors_path, separately=['vectors'])
+        word_vectors = KeyedVectors.load(keyed_vectors_path, mmap='r')
+    return word_vectors
+
+def get_model(device):
+    """
+    Returns the emotion classifier, loaded on first use.
+    """
+    global model
+    if model is None:
+        model = load_inference_model(checkpoint_path)
+    return model.to(device)
+
+def sentence_to_vector(sentence, vectors):
     """
-    Vectorizes inputs using the word2vec model.
+    Vectorizes inputs using the word2vec vectors.
     """
     words = sentence.split()
-    word_vectors = [model.wv[word] for word in words if word in model.wv]
+    word_vectors = [vectors[word] for word in words if word in vectors]
     if len(word_vectors) == 0:
-        return np.zeros(model.vector_size)
+        return np.zeros(vectors.vector_size)
     return np.mean(word_vectors, axis=0)
 
 def predict_emotion(sentence, device):
     """
     Predicts the emotion of the text
     """
-    vec = sentence_to_vector(sentence=sentence, model=word2vec_model)
-    model.to(device)
-    model.eval()
+    vec = sentence_to_vector(sentence=sentence, vectors=get_word_vectors())
+    model = get_model(device)
     input = torch.tensor(vec).unsqueeze(0).to(device)
 
     with torch.no_grad():
@@ -60,4 +90,4 @@ def predict_emotion(sentence, device):
         # Map the predicted index to the corresponding label
         predicted_label = label_mapping[predicted_class_idx]
         print(predicted_label)
-    return predicted_label
\ No newline at end of file
+    return predicted_label
@@ -1,6 +1,12 @@
 import LLMAccess
 import torch
 import os
+import shutil
+import hashlib
+import time
+from concurrent.futures import Future
+from queue import Queue, Empty
+from threading import Thread
 os.environ['KMP_DUPLICATE_LIB_OK'] = 'TRUE'
 from styletts2 import tts as StyleTTS
 from parler_tts import ParlerTTSForConditionalGeneration 
@@ -8,6 +14,9 @@ from transformers import AutoTokenizer
 import numpy as np
 import scipy.io.wavfile as wavfile
 import emotion_text_detect.load_text_model as text_oracle
+import audio
+from lipsync import LipSyncEngine
+from workspace import Workspace
 
 # Get the current working directory
 current_directory = os.getcwd()
@@ -17,13 +26,40 @@ device = "cuda:0" if torch.cuda.is_available() else "cpu"
 model = ParlerTTSForConditionalGeneration.from_pretrained("parler-tts/parler-tts-mini-v1").to(device) 
 tokenizer = AutoTokenizer.from_pretrained("parler-tts/parler-tts-mini-v1")
 
-def emotionalFace(prompt: str, num: int, audio_emotion=""):
+# Load Wav2Lip and the face detector once for the lifetime of the process
+lipsync_engine = LipSyncEngine("checkpoints/wav2lip.pth")
+
+# Number of synthesized sentences the TTS stage may run ahead of the lip-sync stage
+PIPELINE_QUEUE_SIZE = 2
+
+# Concurrent TTS requests are batched: up to TTS_BATCH_SIZE texts, collected for TTS_BATCH_WINDOW seconds
+TTS_BATCH_SIZE = 8
+TTS_BATCH_WINDOW = 0.03
+
+def remove_artifacts(turn: dict):
+    """Deletes the cached WAV/MP4 files of an evicted artifact_cache entry"""
+    for path in (turn.get("audio_file"), turn.get("video") and os.path.join("results", turn["video"])):
+        if path and os.path.isfile(path):
+            os.remove(path)
+
+# Full-turn cache (response, speech and video), so a repeated turn costs only a disk read
+artifact_cache = LLMAccess.ResponseCache("temp/turn_cache.json", max_entries=64, on_evict=remove_artifacts)
+
+def emotionalFace(prompt: str, num: int, audio_emotion="", stream=False, pipelined=False, on_sentence=None):
     """Calls the LLM module to generate a response, then generates the speech 
     and then finally generate the talking face model
 
     Args:
         prompt (str): User input prompt
         num (int): index of the prompt
+        stream (bool): Return the talking face as a stream of batches 
+            (see stream_animation) instead of an MP4 file name
+        pipelined (bool): Stream the LLM response and the talking face sentence by 
+            sentence, the speech of the next sentence is synthesized while the current 
+            one is lip-synced (see pipeline_animation). The text is only known once the 
+            stream is consumed, so text and audio_file are None.
+        on_sentence (callable): In pipelined mode, called with every sentence of the 
+            response as soon as it arrives
 
     Returns:
         tuple: text and video
@@ -32,25 +68,106 @@ def emotionalFace(prompt: str, num: int, audio_emotion=""):
         detect_emotion = audio_emotion
     else:
         detect_emotion = text_oracle.predict_emotion(prompt, device)
-    response = LLMAccess.generate_response(prompt, detect_emotion)
-    audio_file = synthesize_speech(text=response, num=num, emotion=detect_emotion)
-    video = create_animation(audio_file=audio_file, num=num, emotion=detect_emotion)
+    key = LLMAccess.cache_key(prompt, detect_emotion)
+    turn = cached_turn(key)
+    if pipelined:
+        if turn is not None:
+            video = replay_turn(turn, on_sentence)
+        else:
+            sentences = LLMAccess.stream_sentences(prompt, detect_emotion)
+            video = pipeline_animation(sentences, detect_emotion, on_sentence, cache_key=key)
+        return None, detect_emotion, None, video
+    if turn is not None:
+        response, audio_file = turn["response"], turn["audio_file"]
+    else:
+        response = LLMAccess.generate_response(prompt, detect_emotion)
+        audio_file = synthesize_speech(text=response, num=num, emotion=detect_emotion)
+    if stream:
+        video = stream_animation(audio_file=audio_file)
+    elif turn is not None and turn.get("video"):
+        video = turn["video"]
+    else:
+        video = create_animation(audio_file=audio_file, num=num, emotion=detect_emotion)
+    if turn is None or (not stream and not turn.get("video")):
+        cache_turn(key, response, audio_file, None if stream else video)
     return response, detect_emotion, audio_file, video
 
+def cached_turn(key: str):
+    """Returns the artifact_cache entry of a turn if its files still exist, otherwise None"""
+    turn = artifact_cache.get(key)
+    if turn is None or not os.path.isfile(turn["audio_file"]):
+        return None
+    if turn.get("video") and not os.path.isfile(os.path.join("results", turn["video"])):
+        turn = dict(turn, video=None)
+    return turn
+
+def cache_turn(key: str, response: str, audio_file: str, video=None):
+    """Copies the speech (and video) of a turn under names derived from its key, 
+    since the numbered output files get overwritten, and records them in artifact_cache
+
+    Args:
+        key (str): LLMAccess.cache_key of the turn
+        response (str): LLM response
+        audio_file (str): Path to WAV file
+        video (str): MP4 file name in results/, or None if no video was rendered
+    """
+    name = "cached_" + hashlib.sha1(key.encode()).hexdigest()
+    cached_audio = f"audio_result/{name}_audio.wav"
+    os.makedirs("audio_result", exist_ok=True)
+    if os.path.abspath(audio_file) != os.path.abspath(cached_audio):
+        shutil.copyfile(audio_file, cached_audio)
+    cached_video = None
+    if video is not None:
+        cached_video = f"{name}_video.mp4"
+        shutil.copyfile(os.path.join("results", video), os.path.join("results", cached_video))
+    artifact_cache.put(key, {"response": response, "audio_file": cached_audio, "video": cached_video})
+
+def replay_turn(turn: dict, on_sentence=None):
+    """Pipelined mode for a cached turn: reports the cached sentences and streams the 
+    cached speech, skipping the LLM and TTS stages"""
+    for sentence in LLMAccess.split_sentences(turn["response"]):
+        if on_sentence is not None:
+            on_sentence(sentence)
+    yield from stream_animation(turn["audio_file"])
+
 # Define a function to synthesize speech with specific emotions
 def synthesize_speech(text, num, emotion):
-    emotion_styles = {
-        'Joy': "A cheerful and upbeat tone, with a bright and lively delivery.",
-        'Sad': "A slow and melancholic tone, with a soft and gentle delivery.",
-        'Anger': "A loud and intense tone, with a forceful and aggressive delivery.",
-        'Fear': "A trembling and cautious tone, with a hesitant and shaky delivery.",
-        'Love': "A warm and tender tone, with a gentle and affectionate delivery.",
-        'Surprise': "A high-pitched and excited tone, with a sudden and emphatic delivery."
-    }
-
-    style_description = emotion_styles.get(emotion.lower(), "A neutral and clear tone, with a standard delivery.")
-    input_style = tokenizer(style_description, return_tensors="pt")
-    input_text = tokenizer(text, return_tensors="pt")
+    pcm = generate_speech(text, emotion)
+    wav_path = f"audio_result/output_{num}_audio.wav" 
+    wavfile.write(wav_path, model.config.sampling_rate, pcm.T) 
+    # Convert WAV to MP3 using pydub 
+    return wav_path
+
+EMOTION_STYLES = {
+    'Joy': "A cheerful and upbeat tone, with a bright and lively delivery.",
+    'Sad': "A slow and melancholic tone, with a soft and gentle delivery.",
+    'Anger': "A loud and intense tone, with a forceful and aggressive delivery.",
+    'Fear': "A trembling and cautious tone, with a hesitant and shaky delivery.",
+    'Love': "A warm and tender tone, with a gentle and affectionate delivery.",
+    'Surprise': "A high-pitched and excited tone, with a sudden and emphatic delivery."
+}
+
+def generate_speech(text, emotion):
+    """Synthesizes the speech for text with the Parler TTS model. Concurrent calls 
+    (pipeline threads, server sessions) are batched into one generate by speech_batcher
+
+    Returns:
+        np.ndarray: int16 PCM of shape (1, samples) at model.config.sampling_rate
+    """
+    return speech_batcher.synthesize(text, emotion)
+
+def generate_speech_batch(texts, emotions):
+    """Synthesizes the speech of several texts in a single Parler TTS generate call. 
+    The style descriptions and the texts are padded, the attention masks keep the 
+    padding out of the generation, and every audio is cut to its own generated length
+
+    Returns:
+        list: int16 PCM of shape (1, samples) per text, see generate_speech
+    """
+    style_descriptions = [EMOTION_STYLES.get(emotion.lower(), "A neutral and clear tone, with a standard delivery.") 
+                          for emotion in emotions]
+    input_style = tokenizer(style_descriptions, return_tensors="pt", padding=True)
+    input_text = tokenizer(texts, return_tensors="pt", padding=True)
 #
     input_ids = input_style.input_ids.to(device)
     prompt_input_ids = input_text.input_ids.to(device)
@@ -60,23 +177,62 @@ def synthesize_speech(text, num, emotion):
     generation = model.generate(input_ids=input_ids,
                                 prompt_input_ids=prompt_input_ids,
                                 attention_mask=attention_mask,
-                                prompt_attention_mask=prompt_attention_mask)
+                                prompt_attention_mask=prompt_attention_mask,
+                                return_dict_in_generate=True)
 #
-    # Save the audio to a file
-    # Convert to numpy array and ensure correct format 
-    audio = generation.cpu().detach().numpy() 
-    audio = np.squeeze(audio) 
-    if audio.ndim == 1: 
-        audio = np.expand_dims(audio, axis=0) 
-    # Normalize the audio to the range [-1, 1] 
-    audio = audio / np.max(np.abs(audio)) 
-    # Convert to 16-bit PCM format 
-    audio = (audio * 32767).astype(np.int16)
-    
-    wav_path = f"audio_result/output_{num}_audio.wav" 
-    wavfile.write(wav_path, model.config.sampling_rate, audio.T) 
-    # Convert WAV to MP3 using pydub 
-    return wav_path
+    audios = []
+    for i in range(len(texts)):
+        # Convert to numpy array and ensure correct format 
+        pcm = generation.sequences[i, :generation.audios_length[i]].cpu().detach().numpy() 
+        pcm = np.expand_dims(np.squeeze(pcm), axis=0) 
+        # Normalize the audio to the range [-1, 1] 
+        pcm = pcm / np.max(np.abs(pcm)) 
+        # Convert to 16-bit PCM format 
+        audios.append((pcm * 32767).astype(np.int16))
+    return audios
+
+class SpeechBatcher:
+    """Collects the generate_speech requests of all threads for a short window and 
+    synthesizes them with one generate_speech_batch call, so concurrent replies share 
+    the forward passes of the TTS model instead of running one after the other
+    """
+    def __init__(self, max_batch_size=TTS_BATCH_SIZE, window=TTS_BATCH_WINDOW):
+        """
+        Args:
+            max_batch_size (int): A batch is started as soon as it has this many texts
+            window (float): Seconds a batch waits for more texts after the first one
+        """
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self.requests = Queue()
+        Thread(target=self.run, daemon=True).start()
+
+    def synthesize(self, text, emotion):
+        """Blocks until the speech of text is synthesized, see generate_speech"""
+        result = Future()
+        self.requests.put((text, emotion, result))
+        return result.result()
+
+    def run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self.requests.get(timeout=max(0, deadline - time.monotonic())))
+                except Empty:
+                    break
+            texts, emotions, results = zip(*batch)
+            try:
+                audios = generate_speech_batch(list(texts), list(emotions))
+            except Exception as e:
+                for result in results:
+                    result.set_exception(e)
+                continue
+            for result, pcm in zip(results, audios):
+                result.set_result(pcm)
+
+speech_batcher = SpeechBatcher()
 
         
 def create_animation(num: int, emotion: str, audio_file: str):
@@ -95,5 +251,66 @@ def create_animation(num: int, emotion: str, audio_file: str):
     image_path = "input_image.gif" 
     audio_path = audio_file 
     output_path = f"output_{num}_video.mp4"
-    os.system(f"C:/Users/henri/anaconda3/envs/nlp_project/python.exe inference.py --checkpoint_path checkpoints/wav2lip.pth --face {image_path} --audio {audio_path} --outfile {output_path}")
-    return output_path
\ No newline at end of file
+    wav = audio.load_wav(audio_path, 16000)
+    lipsync_engine(wav, image_path, output_path, audio_path=audio_path)
+    return output_path
+
+def stream_animation(audio_file: str):
+    """Streams the talking face instead of writing an MP4, so playback can 
+    start as soon as the first Wav2Lip batch is rendered
+
+    Args:
+        audio_file (str): Path to WAV file
+
+    Returns:
+        generator: (frames, wav span, fps) per batch, see LipSyncEngine.stream
+    """
+    sampling_rate, wav = wavfile.read(audio_file)
+    return lipsync_engine.stream(wav, "input_image.gif", sr=sampling_rate)
+
+def pipeline_animation(sentences, emotion: str, on_sentence=None, cache_key=None):
+    """Streams the talking face sentence by sentence. A worker thread pulls the 
+    sentences and synthesizes their speech into a bounded queue, while the caller 
+    lip-syncs the sentence at the front, so the first frames only wait for the 
+    first sentence
+
+    Args:
+        sentences (iterable): The response, split into sentences (may be a stream, 
+            see LLMAccess.stream_sentences)
+        emotion (str): Detected emotion, selects the speaking style
+        on_sentence (callable): Called from the worker thread with every sentence
+        cache_key (str): If given, the full response and speech are stored in 
+            artifact_cache under this key once the stream is finished
+
+    Returns:
+        generator: (frames, wav span, fps) per batch, see LipSyncEngine.stream
+    """
+    speech = Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    spoken, wavs = [], []
+
+    def synthesize_sentences():
+        try:
+            for sentence in sentences:
+                if on_sentence is not None:
+                    on_sentence(sentence)
+                spoken.append(sentence)
+                speech.put(generate_speech(sentence, emotion))
+        except Exception as e:
+            speech.put(e)
+        speech.put(None)
+
+    Thread(target=synthesize_sentences, daemon=True).start()
+    while True:
+        wav = speech.get()
+        if wav is None:
+            break
+        if isinstance(wav, Exception):
+            raise wav
+        wavs.append(wav)
+        yield from lipsync_engine.stream(wav, "input_image.gif", sr=model.config.sampling_rate)
+
+    if cache_key is not None and wavs:
+        with Workspace() as job:
+            audio_file = job.path("pipelined_audio.wav")
+            wavfile.write(audio_file, model.config.sampling_rate, np.concatenate(wavs, axis=1).T)
+            cache_turn(cache_key, " ".join(spoken), audio_file)
@@ -10,6 +10,7 @@ sys.path.append('../')
 import audio
 import face_detection
 from models import Wav2Lip
+from workspace import Workspace
 
 parser = argparse.ArgumentParser(description='Code to generate results for test filelists')
 
@@ -29,6 +30,9 @@ parser.add_argument('--wav2lip_batch_size', type=int, help='Batch size for Wav2L
 
 # parser.add_argument('--resize_factor', default=1, type=int)
 
+parser.add_argument('--ram_temp', default=False, action='store_true',
+					help='Keep the intermediate audio and video on the RAM disk (/dev/shm) if available')
+
 args = parser.parse_args()
 args.img_size = 96
 
@@ -42,21 +46,9 @@ def get_smoothened_boxes(boxes, T):
 	return boxes
 
 def face_detect(images):
-	batch_size = args.face_det_batch_size
-	
-	while 1:
-		predictions = []
-		try:
-			for i in range(0, len(images), batch_size):
-				predictions.extend(detector.get_detections_for_batch(np.array(images[i:i + batch_size])))
-		except RuntimeError:
-			if batch_size == 1:
-				raise RuntimeError('Image too big to run face detection on GPU')
-			batch_size //= 2
-			args.face_det_batch_size = batch_size
-			print('Recovering from OOM error; New batch size: {}'.format(batch_size))
-			continue
-		break
+	h, w = images[0].shape[:-1]
+	predictions = planner.run(lambda batch: detector.get_detections_for_batch(np.array(batch)), images, (h, w), 
+								args.face_det_batch_size, 'Image too big to run face detection on GPU', show_progress_bar=False)
 
 	results = []
 	pady1, pady2, padx1, padx2 = args.pads
@@ -125,6 +117,7 @@ print('Using {} for inference.'.format(device))
 
 detector = face_detection.FaceAlignment(face_detection.LandmarksType._2D, 
 											flip_input=False, device=device)
+planner = face_detection.BatchPlanner(device)
 
 def _load(checkpoint_path):
 	if device == 'cuda':
@@ -149,7 +142,7 @@ def load_model(path):
 
 model = load_model(args.checkpoint_path)
 
-def main():
+def main(job):
 	assert args.data_root is not None
 	data_root = args.data_root
 
@@ -164,9 +157,9 @@ def main():
 		audio_src = os.path.join(data_root, audio_src) + '.mp4'
 		video = os.path.join(data_root, video) + '.mp4'
 
-		command = 'ffmpeg -loglevel panic -y -i {} -strict -2 {}'.format(audio_src, '../temp/temp.wav')
+		command = 'ffmpeg -loglevel panic -y -i {} -strict -2 {}'.format(audio_src, job.path('temp.wav'))
 		subprocess.call(command, shell=True)
-		temp_audio = '../temp/temp.wav'
+		temp_audio = job.path('temp.wav')
 
 		wav = audio.load_wav(temp_audio, 16000)
 		mel = audio.melspectrogram(wav)
@@ -208,7 +201,7 @@ def main():
 		for i, (img_batch, mel_batch, frames, coords) in enumerate(gen):
 			if i == 0:
 				frame_h, frame_w = full_frames[0].shape[:-1]
-				out = cv2.VideoWriter('../temp/result.avi', 
+				out = cv2.VideoWriter(job.path('result.avi'), 
 								cv2.VideoWriter_fourcc(*'DIVX'), fps, (frame_w, frame_h))
 
 			img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
@@ -231,8 +224,9 @@ def main():
 		vid = os.path.join(args.results_dir, '{}.mp4'.format(idx))
 
 		command = 'ffmpeg -loglevel panic -y -i {} -i {} -strict -2 -q:v 1 {}'.format(temp_audio, 
-								'../temp/result.avi', vid)
+								job.path('result.avi'), vid)
 		subprocess.call(command, shell=True)
 
 if __name__ == '__main__':
-	main()
+	with Workspace('../temp', ram=args.ram_temp) as job:
+		main(job)
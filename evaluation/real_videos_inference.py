@@ -10,6 +10,7 @@ sys.path.append('../')
 import audio
 import face_detection
 from models import Wav2Lip
+from workspace import Workspace
 
 parser = argparse.ArgumentParser(description='Code to generate results on ReSyncED evaluation set')
 
@@ -36,6 +37,9 @@ parser.add_argument('--min_frame_res', help='Do not downsample further below thi
 parser.add_argument('--max_frame_res', help='Downsample to at least this frame resolution', default=720)
 # parser.add_argument('--resize_factor', default=1, type=int)
 
+parser.add_argument('--ram_temp', default=False, action='store_true',
+					help='Keep the intermediate audio and video on the RAM disk (/dev/shm) if available')
+
 args = parser.parse_args()
 args.img_size = 96
 
@@ -71,21 +75,11 @@ def rescale_frames(images):
 
 
 def face_detect(images):
-	batch_size = args.face_det_batch_size
 	images = rescale_frames(images)
 
-	while 1:
-		predictions = []
-		try:
-			for i in range(0, len(images), batch_size):
-				predictions.extend(detector.get_detections_for_batch(np.array(images[i:i + batch_size])))
-		except RuntimeError:
-			if batch_size == 1:
-				raise RuntimeError('Image too big to run face detection on GPU')
-			batch_size //= 2
-			print('Recovering from OOM error; New batch size: {}'.format(batch_size))
-			continue
-		break
+	h, w = images[0].shape[:-1]
+	predictions = planner.run(lambda batch: detector.get_detections_for_batch(np.array(batch)), images, (h, w), 
+								args.face_det_batch_size, 'Image too big to run face detection on GPU', show_progress_bar=False)
 
 	results = []
 	pady1, pady2, padx1, padx2 = args.pads
@@ -172,6 +166,7 @@ print('Using {} for inference.'.format(device))
 
 detector = face_detection.FaceAlignment(face_detection.LandmarksType._2D, 
 											flip_input=False, device=device)
+planner = face_detection.BatchPlanner(device)
 
 def _load(checkpoint_path):
 	if device == 'cuda':
@@ -196,7 +191,7 @@ def load_model(path):
 
 model = load_model(args.checkpoint_path)
 
-def main():
+def main(job):
 	if not os.path.isdir(args.results_dir): os.makedirs(args.results_dir)
 
 	if args.mode == 'dubbed':
@@ -214,9 +209,9 @@ def main():
 		audio_src = os.path.join(args.data_root, audio_src)
 		video = os.path.join(args.data_root, video)
 
-		command = 'ffmpeg -loglevel panic -y -i {} -strict -2 {}'.format(audio_src, '../temp/temp.wav')
+		command = 'ffmpeg -loglevel panic -y -i {} -strict -2 {}'.format(audio_src, job.path('temp.wav'))
 		subprocess.call(command, shell=True)
-		temp_audio = '../temp/temp.wav'
+		temp_audio = job.path('temp.wav')
 
 		wav = audio.load_wav(temp_audio, 16000)
 		mel = audio.melspectrogram(wav)
@@ -275,7 +270,7 @@ def main():
 			if i == 0:
 				frame_h, frame_w = full_frames[0].shape[:-1]
 
-				out = cv2.VideoWriter('../temp/result.avi', 
+				out = cv2.VideoWriter(job.path('result.avi'), 
 								cv2.VideoWriter_fourcc(*'DIVX'), fps, (frame_w, frame_h))
 
 			img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
@@ -296,10 +291,11 @@ def main():
 		out.release()
 
 		vid = os.path.join(args.results_dir, '{}.mp4'.format(idx))
-		command = 'ffmpeg -loglevel panic -y -i {} -i {} -strict -2 -q:v 1 {}'.format('../temp/temp.wav', 
-								'../temp/result.avi', vid)
+		command = 'ffmpeg -loglevel panic -y -i {} -i {} -strict -2 -q:v 1 {}'.format(temp_audio, 
+								job.path('result.avi'), vid)
 		subprocess.call(command, shell=True)
 
 
 if __name__ == '__main__':
-	main()
+	with Workspace('../temp', ram=args.ram_temp) as job:
+		main(job)
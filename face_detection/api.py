@@ -61,7 +61,62 @@ class FaceAlignment:
                                           globals(), locals(), [face_detector], 0)
         self.face_detector = face_detector_module.FaceDetector(device=device, verbose=verbose)
 
-    def get_detections_for_batch(self, images):
+    def get_detections_for_batch(self, images, scale=1., refine=False):
+        """Detects the most confident face of every image of a batch.
+
+        Arguments:
+            images {numpy.ndarray} -- batch of BGR images, shape [N, H, W, 3]
+
+        Keyword Arguments:
+            scale {float} -- run the detector on a copy of the batch resized by this factor
+            (see detect_scale), the boxes are mapped back to full resolution (default: {1.})
+            refine {bool} -- detect again at full resolution on a crop around every box
+            found at the reduced scale (default: {False})
+        """
+        if scale == 1.:
+            return self._detect_batch(images)
+
+        small = np.asarray([cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+                            for image in images])
+        results = []
+        for image, rect in zip(images, self._detect_batch(small)):
+            if rect is not None:
+                h, w = image.shape[:2]
+                x1, y1, x2, y2 = [int(round(v / scale)) for v in rect]
+                rect = (min(x1, w), min(y1, h), min(x2, w), min(y2, h))
+                if refine:
+                    rect = self._refine(image, rect)
+            results.append(rect)
+
+        return results
+
+    def detect_scale(self, image, face_size=160, probe_size=480, min_size=240):
+        """Returns the downscale factor (<= 1) at which the face in image is about face_size
+        pixels, found with one detection on a probe copy whose shorter side is probe_size.
+        The shorter side of the image is never scaled below min_size."""
+        h, w = image.shape[:2]
+        probe_scale = min(1., probe_size / float(min(h, w)))
+        rect = self.get_detections_for_batch(np.asarray([image]), scale=probe_scale)[0]
+        if rect is None:
+            return 1.
+
+        x1, y1, x2, y2 = rect
+        scale = face_size / float(max(x2 - x1, y2 - y1, 1))
+        return float(np.clip(scale, min(1., min_size / float(min(h, w))), 1.))
+
+    def _refine(self, image, rect):
+        x1, y1, x2, y2 = rect
+        margin_x, margin_y = (x2 - x1) // 2, (y2 - y1) // 2
+        cx1, cy1 = max(0, x1 - margin_x), max(0, y1 - margin_y)
+        cx2, cy2 = min(image.shape[1], x2 + margin_x), min(image.shape[0], y2 + margin_y)
+
+        refined = self._detect_batch(np.asarray([image[cy1:cy2, cx1:cx2]]))[0]
+        if refined is None:
+            return rect
+        rx1, ry1, rx2, ry2 = refined
+        return (cx1 + rx1, cy1 + ry1, cx1 + rx2, cy1 + ry2)
+
+    def _detect_batch(self, images):
         images = images[..., ::-1]
         detected_faces = self.face_detector.detect_from_batch(images.copy())
         results = []
@@ -76,4 +131,4 @@ class FaceAlignment:
             x1, y1, x2, y2 = map(int, d[:-1])
             results.append((x1, y1, x2, y2))
 
-        return results
\ No newline at end of file
+        return results
@@ -0,0 +1,97 @@
+import os
+import torch
+from tqdm import tqdm
+
+
+def is_out_of_memory(error):
+    """Whether error is a (CUDA or host) out-of-memory error of a detection batch"""
+    if isinstance(error, MemoryError):
+        return True
+    if hasattr(torch.cuda, 'OutOfMemoryError') and isinstance(error, torch.cuda.OutOfMemoryError):
+        return True
+    message = str(error)
+    return 'out of memory' in message or "can't allocate memory" in message
+
+
+class BatchPlanner(object):
+    """Chooses face detection batch sizes from the free memory of the device.
+
+    The first batch size for a frame resolution is estimated from the number of
+    pixels and the free GPU (or CPU) memory. If a batch still runs out of memory,
+    the size for that resolution is set to half of that batch and detection resumes
+    from it. Other errors are raised. Sizes are remembered per resolution across calls.
+    """
+
+    def __init__(self, device, bytes_per_pixel=600, headroom=0.8):
+        """
+        Arguments:
+            device {string} -- 'cpu' or 'cuda[:index]'
+
+        Keyword Arguments:
+            bytes_per_pixel {int} -- estimated peak S3FD memory per input pixel (default: {600})
+            headroom {float} -- fraction of the free memory that may be planned for (default: {0.8})
+        """
+        self.device = device
+        self.bytes_per_pixel = bytes_per_pixel
+        self.headroom = headroom
+        self.sizes = {}
+
+    def free_memory(self):
+        """Free memory of the device in bytes, or None if it cannot be determined"""
+        if 'cuda' in self.device:
+            device = torch.device(self.device)
+            if hasattr(torch.cuda, 'mem_get_info'):
+                return torch.cuda.mem_get_info(device)[0]
+            total = torch.cuda.get_device_properties(device).total_memory
+            return total - torch.cuda.memory_reserved(device)
+        try:
+            return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        except (AttributeError, ValueError, OSError):
+            return None
+
+    def batch_size(self, resolution, max_batch_size):
+        """Batch size for frames of the given (height, width), at most max_batch_size"""
+        if resolution not in self.sizes:
+            free = self.free_memory()
+            if free is None:
+                size = max_batch_size
+            else:
+                per_frame = self.bytes_per_pixel * resolution[0] * resolution[1]
+                size = int(free * self.headroom // per_frame)
+            self.sizes[resolution] = max(1, min(size, max_batch_size))
+        return min(self.sizes[resolution], max_batch_size)
+
+    def shrink(self, resolution, size, message='Image too big to run face detection'):
+        """Halves the batch size of a resolution after a batch of the given size ran out of memory"""
+        if size == 1:
+            raise RuntimeError(message)
+        self.sizes[resolution] = size // 2
+        if 'cuda' in self.device:
+            torch.cuda.empty_cache()
+        print('Recovering from OOM error; New batch size: {}'.format(self.sizes[resolution]))
+
+    def run(self, detect, images, resolution, max_batch_size, message='Image too big to run face detection',
+            show_progress_bar=True):
+        """Runs detect over images in planned batches and returns the concatenated results.
+
+        Arguments:
+            detect {callable} -- maps a list of images to a list of results
+            images {list} -- the images to process
+            resolution {tuple} -- (height, width) the detector sees, used for planning
+            max_batch_size {int} -- upper bound of the batch size
+        """
+        results = []
+        with tqdm(total=len(images), disable=not show_progress_bar) as progress:
+            while len(results) < len(images):
+                start = len(results)
+                batch = images[start:start + self.batch_size(resolution, max_batch_size)]
+                try:
+                    batch_results = detect(batch)
+                except (RuntimeError, MemoryError) as e:
+                    if not is_out_of_memory(e):
+                        raise
+                    self.shrink(resolution, len(batch), message)
+                    continue
+                results.extend(batch_results)
+                progress.update(len(batch_results))
+        return results
@@ -26,6 +26,12 @@ except BaseException:
         else:
             return 1.0 * w * h / (sa + sb - w * h)
 
+try:
+    from torchvision.ops import batched_nms as tv_batched_nms
+except BaseException:
+    # vectorized NumPy fallback in batched_nms
+    tv_batched_nms = None
+
 
 def bboxlog(x1, y1, x2, y2, axc, ayc, aww, ahh):
     xc, yc, ww, hh = (x2 + x1) / 2, (y2 + y1) / 2, x2 - x1, y2 - y1
@@ -64,6 +70,44 @@ def nms(dets, thresh):
     return keep
 
 
+def batched_nms(dets, idxs, thresh):
+    """Non-maximum suppression of the detections of a whole batch of images at once.
+    Args:
+        dets: (ndarray) [x1, y1, x2, y2, score] rows of all images, Shape: [num_dets, 5]
+        idxs: (ndarray) image index of every row, Shape: [num_dets]
+        thresh: (float) IoU above which the lower scoring box of an image is suppressed
+    Return:
+        indices of the kept rows, by decreasing score
+    """
+    if 0 == len(dets):
+        return np.zeros(0, dtype=np.int64)
+    if tv_batched_nms is not None:
+        # x2, y2 + 1: torchvision has no +1 in its box sizes, this keeps the IoU of nms above
+        boxes = np.concatenate([dets[:, :2], dets[:, 2:4] + 1], axis=1)
+        return tv_batched_nms(torch.from_numpy(boxes).float(), torch.from_numpy(dets[:, 4]).float(),
+                              torch.from_numpy(idxs), thresh).numpy()
+
+    # shift the boxes of every image to their own region, so boxes of different images never overlap
+    offsets = idxs * (dets[:, :4].max() - dets[:, :4].min() + 2)
+    order = dets[:, 4].argsort()[::-1]
+    x1, y1, x2, y2 = [(dets[:, k] + offsets)[order] for k in range(4)]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+    w = np.maximum(0.0, np.minimum(x2[:, None], x2[None]) - np.maximum(x1[:, None], x1[None]) + 1)
+    h = np.maximum(0.0, np.minimum(y2[:, None], y2[None]) - np.maximum(y1[:, None], y1[None]) + 1)
+    ovr = w * h / (areas[:, None] + areas[None] - w * h)
+
+    suppressed = np.zeros(len(order), dtype=bool)
+    keep = []
+    for i in range(len(order)):
+        if suppressed[i]:
+            continue
+        keep.append(order[i])
+        suppressed |= ovr[i] > thresh
+
+    return np.array(keep, dtype=np.int64)
+
+
 def encode(matched, priors, variances):
     """Encode the variances from the priorbox layers into the ground truth boxes
     we have matched (based on jaccard overlap) with the prior boxes.
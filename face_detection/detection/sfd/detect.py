@@ -16,6 +16,22 @@ from .net_s3fd import s3fd
 from .bbox import *
 
 
+# Anchor centres and sizes per (feature map size, stride, device), see get_priors
+_priors_cache = {}
+
+
+def get_priors(FH, FW, stride, device):
+    """Prior boxes (cx, cy, w, h) of every cell of a FH x FW feature map, flattened
+    row-major to shape [FH * FW, 4]. Cached, they only depend on the feature map size."""
+    key = (FH, FW, stride, str(device))
+    if key not in _priors_cache:
+        ys, xs = torch.meshgrid(torch.arange(FH, dtype=torch.float32), torch.arange(FW, dtype=torch.float32))
+        priors = torch.stack([stride / 2 + xs * stride, stride / 2 + ys * stride,
+                              torch.full_like(xs, stride * 4.), torch.full_like(xs, stride * 4.)], 2)
+        _priors_cache[key] = priors.view(-1, 4).to(device)
+    return _priors_cache[key]
+
+
 def detect(net, img, device):
     img = img - np.array([104, 117, 123])
     img = img.transpose(2, 0, 1)
@@ -29,31 +45,27 @@ def detect(net, img, device):
     with torch.no_grad():
         olist = net(img)
 
-    bboxlist = []
-    for i in range(len(olist) // 2):
-        olist[i * 2] = F.softmax(olist[i * 2], dim=1)
-    olist = [oelem.data.cpu() for oelem in olist]
-    for i in range(len(olist) // 2):
-        ocls, oreg = olist[i * 2], olist[i * 2 + 1]
-        FB, FC, FH, FW = ocls.size()  # feature map size
-        stride = 2**(i + 2)    # 4,8,16,32,64,128
-        anchor = stride * 4
-        poss = zip(*np.where(ocls[:, 1, :, :] > 0.05))
-        for Iindex, hindex, windex in poss:
-            axc, ayc = stride / 2 + windex * stride, stride / 2 + hindex * stride
-            score = ocls[0, 1, hindex, windex]
-            loc = oreg[0, :, hindex, windex].contiguous().view(1, 4)
-            priors = torch.Tensor([[axc / 1.0, ayc / 1.0, stride * 4 / 1.0, stride * 4 / 1.0]])
+        bboxlist = []
+        for i in range(len(olist) // 2):
+            olist[i * 2] = F.softmax(olist[i * 2], dim=1)
+        for i in range(len(olist) // 2):
+            ocls, oreg = olist[i * 2], olist[i * 2 + 1]
+            FB, FC, FH, FW = ocls.size()  # feature map size
+            stride = 2**(i + 2)    # 4,8,16,32,64,128
+            scores = ocls[0, 1].reshape(-1)
+            poss = scores > 0.05
+            if not poss.any():
+                continue
+            loc = oreg[0].permute(1, 2, 0).reshape(-1, 4)[poss]
+            priors = get_priors(FH, FW, stride, ocls.device)[poss]
             variances = [0.1, 0.2]
             box = decode(loc, priors, variances)
-            x1, y1, x2, y2 = box[0] * 1.0
-            # cv2.rectangle(imgshow,(int(x1),int(y1)),(int(x2),int(y2)),(0,0,255),1)
-            bboxlist.append([x1, y1, x2, y2, score])
-    bboxlist = np.array(bboxlist)
+            bboxlist.append(torch.cat([box, scores[poss].unsqueeze(1)], 1).cpu().numpy())
+
     if 0 == len(bboxlist):
-        bboxlist = np.zeros((1, 5))
+        return np.zeros((1, 5))
 
-    return bboxlist
+    return np.concatenate(bboxlist, 0)
 
 def batch_detect(net, imgs, device):
     imgs = imgs - np.array([104, 117, 123])
@@ -67,31 +79,29 @@ def batch_detect(net, imgs, device):
     with torch.no_grad():
         olist = net(imgs)
 
-    bboxlist = []
-    for i in range(len(olist) // 2):
-        olist[i * 2] = F.softmax(olist[i * 2], dim=1)
-    olist = [oelem.data.cpu() for oelem in olist]
-    for i in range(len(olist) // 2):
-        ocls, oreg = olist[i * 2], olist[i * 2 + 1]
-        FB, FC, FH, FW = ocls.size()  # feature map size
-        stride = 2**(i + 2)    # 4,8,16,32,64,128
-        anchor = stride * 4
-        poss = zip(*np.where(ocls[:, 1, :, :] > 0.05))
-        for Iindex, hindex, windex in poss:
-            axc, ayc = stride / 2 + windex * stride, stride / 2 + hindex * stride
-            score = ocls[:, 1, hindex, windex]
-            loc = oreg[:, :, hindex, windex].contiguous().view(BB, 1, 4)
-            priors = torch.Tensor([[axc / 1.0, ayc / 1.0, stride * 4 / 1.0, stride * 4 / 1.0]]).view(1, 1, 4)
+        bboxlist = []
+        for i in range(len(olist) // 2):
+            olist[i * 2] = F.softmax(olist[i * 2], dim=1)
+        for i in range(len(olist) // 2):
+            ocls, oreg = olist[i * 2], olist[i * 2 + 1]
+            FB, FC, FH, FW = ocls.size()  # feature map size
+            stride = 2**(i + 2)    # 4,8,16,32,64,128
+            scores = ocls[:, 1].reshape(BB, -1)
+            # anchors scoring above 0.05 in any image of the batch are kept for all images
+            poss = (scores > 0.05).any(0)
+            if not poss.any():
+                continue
+            loc = oreg.permute(0, 2, 3, 1).reshape(BB, -1, 4)[:, poss]
+            priors = get_priors(FH, FW, stride, ocls.device)[poss].unsqueeze(0)
             variances = [0.1, 0.2]
             box = batch_decode(loc, priors, variances)
-            box = box[:, 0] * 1.0
-            # cv2.rectangle(imgshow,(int(x1),int(y1)),(int(x2),int(y2)),(0,0,255),1)
-            bboxlist.append(torch.cat([box, score.unsqueeze(1)], 1).cpu().numpy())
-    bboxlist = np.array(bboxlist)
+            box = torch.cat([box, scores[:, poss].unsqueeze(2)], 2)
+            bboxlist.append(box.transpose(0, 1).cpu().numpy())
+
     if 0 == len(bboxlist):
-        bboxlist = np.zeros((1, BB, 5))
+        return np.zeros((1, BB, 5))
 
-    return bboxlist
+    return np.concatenate(bboxlist, 0)
 
 def flip_detect(net, img, device):
     img = cv2.flip(img, 1)
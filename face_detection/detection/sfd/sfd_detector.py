@@ -32,19 +32,26 @@ class SFDDetector(FaceDetector):
         image = self.tensor_or_path_to_ndarray(tensor_or_path)
 
         bboxlist = detect(self.face_detector, image, device=self.device)
+        # boxes below 0.5 could only suppress boxes that are dropped anyway, so filter before NMS
+        bboxlist = bboxlist[bboxlist[:, -1] > 0.5]
         keep = nms(bboxlist, 0.3)
-        bboxlist = bboxlist[keep, :]
-        bboxlist = [x for x in bboxlist if x[-1] > 0.5]
+        bboxlist = [x for x in bboxlist[keep, :]]
 
         return bboxlist
 
     def detect_from_batch(self, images):
         bboxlists = batch_detect(self.face_detector, images, device=self.device)
-        keeps = [nms(bboxlists[:, i, :], 0.3) for i in range(bboxlists.shape[1])]
-        bboxlists = [bboxlists[keep, i, :] for i, keep in enumerate(keeps)]
-        bboxlists = [[x for x in bboxlist if x[-1] > 0.5] for bboxlist in bboxlists]
+        num_images = bboxlists.shape[1]
+        dets = bboxlists.transpose(1, 0, 2).reshape(-1, 5)
+        idxs = np.repeat(np.arange(num_images), bboxlists.shape[0])
 
-        return bboxlists
+        # boxes below 0.5 could only suppress boxes that are dropped anyway, so filter before NMS
+        valid = dets[:, -1] > 0.5
+        dets, idxs = dets[valid], idxs[valid]
+        keep = batched_nms(dets, idxs, 0.3)
+        dets, idxs = dets[keep], idxs[keep]
+
+        return [[x for x in dets[idxs == i]] for i in range(num_images)]
 
     @property
     def reference_scale(self):
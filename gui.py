@@ -11,7 +11,9 @@ import emotionalFace
 from moviepy.editor import VideoFileClip
 from PIL import Image, ImageTk
 from threading import Thread
-import time
+from queue import Queue, Empty
+import numpy as np
+import pyaudio
 from record_audio import record_audio
 
 __author__ = "Albane Keraudren-Riguidel, Henrik Klasen"
@@ -37,6 +39,10 @@ def num():
         yield num
 n = num()
 emotion_global = ""
+# Stream the response, speech and talking face sentence by sentence and batch by batch,
+# instead of waiting for the MP4
+STREAM_VIDEO = True
+streamBuffer = []
 def sendText():
     """
     This function is triggred upon press of the send button. It passes the text input on to the 
@@ -49,6 +55,12 @@ def sendText():
         textDisplay.insert(END, f"You => {userInput}\n")
         entrybox.delete(0, END)
         print(emotion_global)
+        if STREAM_VIDEO:
+            response_gemini, emotion, _, video_path = emotionalFace.emotionalFace(userInput, next(n), emotion_global, pipelined=True, on_sentence=showSentence)
+            emotion_global=""
+            textDisplay.insert(END, f"Chatty => You sound {emotion}\n")
+            playStream(video_path)
+            return
         if emotion_global != "":
             response_gemini, emotion, _, video_path = emotionalFace.emotionalFace(userInput, next(n), emotion_global) 
         else:
@@ -58,6 +70,12 @@ def sendText():
         playVideo(video_path)
         textDisplay.insert(END, f"Chatty => You sound {emotion}\n{response_gemini}")
 
+def showSentence(sentence: str):
+    """
+    Appends a sentence of the streamed LLM response to the chat, as soon as it arrives.
+    """
+    textDisplay.insert(END, sentence + " ")
+
 def playVideo(videoPath: str):
     """
     Plays the MP4 video, with more or less good lip syncing.
@@ -97,6 +115,84 @@ def playVideo(videoPath: str):
     updateFrame()  # Start the video loop
     replayButton.configure(state=NORMAL)
 
+def playStream(stream, sampleRate=None):
+    """
+    Plays a talking face stream while it is still being rendered.
+
+    @param stream, generator of (frames, wav span, fps) batches from emotionalFace.stream_animation
+    @param sampleRate, sampling rate of the wav spans (default: the Parler TTS rate)
+
+    Description: One thread pulls the batches from the stream, which is where the rendering
+    happens, so batch N+1 renders while batch N plays. A second thread plays the audio spans
+    with pyaudio and hands the frames to the Tkinter loop. The batches are kept for replay.
+    """
+    global streamBuffer
+    if sampleRate is None:
+        sampleRate = emotionalFace.model.config.sampling_rate
+    played = streamBuffer = []
+    batchQueue = Queue()
+    frameQueue = Queue()
+
+    def renderBatches():
+        try:
+            for batch in stream:
+                batchQueue.put(batch)
+        except Exception as e:
+            # Shown by updateFrame, the playback still ends normally
+            batchQueue.put(e)
+        finally:
+            batchQueue.put(None)
+
+    def playBatches():
+        p = pyaudio.PyAudio()
+        audioStream = p.open(format=pyaudio.paFloat32, channels=1, rate=sampleRate, output=True)
+        try:
+            while True:
+                batch = batchQueue.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    frameQueue.put(batch)
+                    continue
+                played.append(batch)
+                frames, wavSpan, fps = batch
+                for frame in frames:
+                    frameQueue.put((frame, fps))
+                audioStream.write(wavSpan.astype(np.float32).tobytes())
+        finally:
+            frameQueue.put(None)
+            audioStream.stop_stream()
+            audioStream.close()
+            p.terminate()
+
+    def updateFrame():
+        """
+        Shows the next streamed frame, or waits for the renderer to catch up.
+        """
+        try:
+            item = frameQueue.get_nowait()
+        except Empty:
+            videoLabel.after(10, updateFrame)
+            return
+        if item is None:
+            replayButton.configure(state=NORMAL)
+            return
+        if isinstance(item, Exception):
+            textDisplay.insert(END, f"\nChatty => Sorry, something went wrong: {item}\n")
+            videoLabel.after(0, updateFrame)
+            return
+        frame, fps = item
+        frame = Image.fromarray(np.ascontiguousarray(frame[..., ::-1]))  # BGR to RGB
+        imageTkinter = ImageTk.PhotoImage(image=frame)
+        videoLabel.imageTkinter = imageTkinter
+        videoLabel.configure(image=imageTkinter)
+        videoLabel.after(int(1000 / fps), updateFrame)
+
+    replayButton.configure(state=DISABLED)
+    Thread(target=renderBatches, daemon=True).start()
+    Thread(target=playBatches, daemon=True).start()
+    updateFrame()
+
 def playAudio(videoClip: VideoFileClip):
     """
     Plays audio
@@ -113,7 +209,10 @@ def replayVideo():
     Replays the video by calling the playVideo function.
     """
     replayButton.configure(state=DISABLED)
-    playVideo(videoPath=video_path)
+    if STREAM_VIDEO:
+        playStream(iter(streamBuffer))
+    else:
+        playVideo(videoPath=video_path)
 
 def startRecording():
     """
@@ -122,31 +221,32 @@ def startRecording():
     recordButton.configure(state=DISABLED)
     progressBar['value'] = 0
     progressBar.update()
-    progressThread = Thread(target=updateProgressBar)
-    progressThread.start()
     recordThread = Thread(target=recordAndProcess)
     recordThread.start()
 
 def recordAndProcess():
     """
     Records audio using the record_audio.py module. 
+    Recording stops after a second of silence, or after 10s at most.
     Gets transscribed text, as well as detected emotion from the machine learning model.
     Emotion is stored in a global variable, for the sendText-function to pass to emotionalFace
     """
     global emotion_global
-    _, text, audio_emotion = record_audio(10, "./audio_in/output{n}.wav")
+    _, text, audio_emotion = record_audio(10, "./audio_in/output{n}.wav", stop_on_silence=True, on_progress=updateProgressBar)
+    progressBar['value'] = 100
+    progressBar.update()
     emotion_global = audio_emotion
     entrybox.insert(0, text)
     recordButton.configure(state=NORMAL)
 
-def updateProgressBar():
+def updateProgressBar(elapsed: float, duration: float):
     """
-    Updates the progress bar every second
-    (10s for completing the audio)
+    Updates the progress bar with the recording progress
+    (reported by record_audio after every chunk, redrawn on every full percent)
     """
-    for i in range(10):
-        time.sleep(1)
-        progressBar['value'] += 10
+    value = int(100 * elapsed / duration)
+    if value != progressBar['value']:
+        progressBar['value'] = value
         progressBar.update()
 
 # Constants for graphics
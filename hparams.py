@@ -43,6 +43,8 @@ hparams = HParams(
 	n_fft=800,  # Extra window size is filled with 0 paddings to match this parameter
 	hop_size=200,  # For 16000Hz, 200 = 12.5 ms (0.0125 * sample_rate)
 	win_size=800,  # For 16000Hz, 800 = 50 ms (If None, win_size = n_fft) (0.05 * sample_rate)
+	stft_pad_mode="reflect",  # Padding of the centered STFT frames. Set explicitly, since the librosa default changed 
+	# from reflect to constant (zeros) in 0.10
 	sample_rate=16000,  # 16000Hz (corresponding to librispeech) (sox --i <filename>)
 	
 	frame_shift_ms=None,  # Can replace hop_size parameter. (Recommended: 12.5)
@@ -1,11 +1,12 @@
 from os import listdir, path
 import numpy as np
 import scipy, cv2, os, sys, argparse, audio
-import json, subprocess, random, string
+import json, subprocess, random, string, hashlib, uuid
 from tqdm import tqdm
 from glob import glob
 import torch, face_detection
 from models import Wav2Lip
+from workspace import Workspace
 import platform
 
 parser = argparse.ArgumentParser(description='Inference code to lip-sync videos in the wild using Wav2Lip models')
@@ -50,7 +51,43 @@ parser.add_argument('--rotate', default=False, action='store_true',
 parser.add_argument('--nosmooth', default=False, action='store_true',
 					help='Prevent smoothing face detections over a short temporal window')
 
-args = parser.parse_args()
+parser.add_argument('--track_every', type=int, default=0,
+					help='Run the face detector only on every n-th frame and track the face in between by template matching. '
+					'0 runs the detector on every frame')
+parser.add_argument('--track_threshold', type=float, default=0.7,
+					help='Tracking confidence (normalized correlation) below which the detector is run on the frame')
+
+parser.add_argument('--auto_resize', default=False, action='store_true',
+					help='Run face detection on frames downscaled automatically so the face is about --det_face_size pixels, '
+					'instead of full resolution. Boxes are mapped back to the full frames')
+parser.add_argument('--det_face_size', type=int, default=160,
+					help='Face size in pixels targeted by --auto_resize')
+parser.add_argument('--refine_detections', default=False, action='store_true',
+					help='With --auto_resize, detect again at full resolution on a crop around every box')
+
+parser.add_argument('--avatar_cache_dir', type=str, default=None,
+					help='Cache the decoded face frames, detections and Wav2Lip face inputs in this folder, '
+					'keyed on the file content and --pads. Later runs on the same face skip face detection')
+
+parser.add_argument('--encoder', type=str, default='ffmpeg', choices=['ffmpeg', 'moviepy'],
+					help='ffmpeg pipes the frames and the audio into a single H.264/AAC encode. moviepy writes an '
+					'intermediate AVI and muxes the audio in a second encode')
+parser.add_argument('--movflags', type=str, default='faststart',
+					choices=['faststart', 'fragmented', 'none'],
+					help='MP4 layout of the ffmpeg encoder: faststart (index first, plays while downloading), '
+					'fragmented (playable while it is written) or none')
+
+parser.add_argument('--temp_dir', type=str, default='temp',
+					help='Folder the per-run scratch directories (extracted audio, intermediate video) are created in')
+parser.add_argument('--ram_temp', default=False, action='store_true',
+					help='Create the per-run scratch directories on the RAM disk (/dev/shm) if available')
+
+if __name__ == '__main__':
+	args = parser.parse_args()
+else:
+	# Imported as a module (e.g. by lipsync.LipSyncEngine): start from the CLI defaults,
+	# the checkpoint, face and audio are passed in by the caller instead.
+	args = parser.parse_args(['--checkpoint_path', '', '--face', '', '--audio', ''])
 args.img_size = 96
 
 if os.path.isfile(args.face) and args.face.split('.')[1] in ['jpg', 'png', 'jpeg']:
@@ -65,32 +102,103 @@ def get_smoothened_boxes(boxes, T):
 		boxes[i] = np.mean(window, axis=0)
 	return boxes
 
-def face_detect(images):
-	detector = face_detection.FaceAlignment(face_detection.LandmarksType._2D, 
-											flip_input=False, device=device)
-
-	batch_size = args.face_det_batch_size
-	
-	while 1:
-		predictions = []
-		try:
-			for i in tqdm(range(0, len(images), batch_size)):
-				predictions.extend(detector.get_detections_for_batch(np.array(images[i:i + batch_size])))
-		except RuntimeError:
-			if batch_size == 1: 
-				raise RuntimeError('Image too big to run face detection on GPU. Please use the --resize_factor argument')
-			batch_size //= 2
-			print('Recovering from OOM error; New batch size: {}'.format(batch_size))
-			continue
-		break
+def detection_scale(images, detector):
+	"""Downscale factor for detecting the faces of one face source, probed on its first frame 
+	with --auto_resize (1 otherwise). Other sources, even of the same resolution, probe their own."""
+	if not args.auto_resize:
+		return 1.
+	scale = detector.detect_scale(images[0], face_size=args.det_face_size)
+	print('Detecting faces at scale {:.2f}'.format(scale))
+	return scale
+
+def detect_faces(images, detector, scale=1.):
+	"""Detects the face in every image at the given scale. Images without a face at a reduced 
+	scale are detected again at full resolution, before their boxes are interpolated."""
+	h, w = images[0].shape[:2]
+	detect = lambda batch: detector.get_detections_for_batch(np.array(batch), scale=scale, refine=args.refine_detections)
+	predictions = list(face_det_planner.run(detect, images, (int(h * scale), int(w * scale)), args.face_det_batch_size, 
+				'Image too big to run face detection on GPU. Please use the --resize_factor argument'))
+
+	missed = [i for i, rect in enumerate(predictions) if rect is None]
+	if scale < 1. and len(missed) > 0:
+		print('Face not detected in {} frames at scale {:.2f}, retrying at full resolution'.format(len(missed), scale))
+		for i, rect in zip(missed, detect_faces([images[i] for i in missed], detector)):
+			predictions[i] = rect
+	return predictions
+
+def match_face(prev_image, rect, image):
+	"""Finds the face of prev_image (at rect) in image, searching a window around rect.
+	Returns the moved rect and the normalized correlation of the match"""
+	x1, y1, x2, y2 = rect
+	margin_x, margin_y = (x2 - x1) // 4, (y2 - y1) // 4
+	sx1, sy1 = max(0, x1 - margin_x), max(0, y1 - margin_y)
+	sx2, sy2 = min(image.shape[1], x2 + margin_x), min(image.shape[0], y2 + margin_y)
+
+	template = cv2.cvtColor(prev_image[y1:y2, x1:x2], cv2.COLOR_BGR2GRAY)
+	search = cv2.cvtColor(image[sy1:sy2, sx1:sx2], cv2.COLOR_BGR2GRAY)
+	if template.size == 0 or search.shape[0] < template.shape[0] or search.shape[1] < template.shape[1]:
+		return rect, 0.
+
+	_, score, _, (dx, dy) = cv2.minMaxLoc(cv2.matchTemplate(search, template, cv2.TM_CCOEFF_NORMED))
+	return (sx1 + dx, sy1 + dy, sx1 + dx + x2 - x1, sy1 + dy + y2 - y1), score
+
+def track_faces(images, detector, every, scale=1.):
+	"""Runs the detector (at scale) on every `every`-th frame only and follows the face in between
+	by template matching. Frames where the match is weak are detected again."""
+	predictions = [None] * len(images)
+	keyframes = list(range(0, len(images), every))
+	for i, rect in zip(keyframes, detect_faces([images[i] for i in keyframes], detector, scale)):
+		predictions[i] = rect
+
+	detected = set(keyframes)
+	runs = len(keyframes)
+	last = None
+	for i in range(len(images)):
+		if predictions[i] is None and last is not None:
+			rect, score = match_face(images[last], predictions[last], images[i])
+			if score >= args.track_threshold:
+				predictions[i] = rect
+			elif i not in detected:
+				predictions[i] = detect_faces([images[i]], detector, scale)[0]
+				runs += 1
+		if predictions[i] is not None:
+			last = i
+
+	print('Face detector run on {} of {} frames'.format(runs, len(images)))
+	return predictions
+
+def fill_missing_faces(predictions, images):
+	"""Interpolates the boxes of frames without a detected face from the neighbouring frames"""
+	found = [i for i, rect in enumerate(predictions) if rect is not None]
+	if len(found) == 0:
+		# Kept for inspection under a unique name, the job workspaces are removed on error
+		os.makedirs(args.temp_dir, exist_ok=True)
+		faulty_frame = path.join(args.temp_dir, 'faulty_frame_{}.jpg'.format(uuid.uuid4().hex))
+		cv2.imwrite(faulty_frame, images[0])
+		raise ValueError('Face not detected! Ensure the video contains a face (see {}).'.format(faulty_frame))
+	if len(found) == len(predictions):
+		return predictions
+
+	print('Face not detected in {} frames, interpolating their boxes'.format(len(predictions) - len(found)))
+	rects = np.array([predictions[i] for i in found], dtype=np.float64)
+	filled = np.stack([np.interp(np.arange(len(predictions)), found, rects[:, k]) for k in range(4)], axis=1)
+	return [tuple(int(round(v)) for v in rect) for rect in filled]
+
+def face_detect(images, detector=None):
+	if detector is None:
+		detector = face_detection.FaceAlignment(face_detection.LandmarksType._2D, 
+												flip_input=False, device=device)
+
+	scale = detection_scale(images, detector)
+	if args.track_every > 1:
+		predictions = track_faces(images, detector, args.track_every, scale)
+	else:
+		predictions = detect_faces(images, detector, scale)
+	predictions = fill_missing_faces(predictions, images)
 
 	results = []
 	pady1, pady2, padx1, padx2 = args.pads
 	for rect, image in zip(predictions, images):
-		if rect is None:
-			cv2.imwrite('temp/faulty_frame.jpg', image) # check this frame where the face was not detected.
-			raise ValueError('Face not detected! Ensure the video contains a face in all the frames.')
-
 		y1 = max(0, rect[1] - pady1)
 		y2 = min(image.shape[0], rect[3] + pady2)
 		x1 = max(0, rect[0] - padx1)
@@ -105,58 +213,87 @@ def face_detect(images):
 	del detector
 	return results 
 
-def datagen(frames, mels):
-	img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
-
+def get_face_det_results(frames, detector=None, static=None):
+	"""static: whether frames is one still image (default: --static)"""
+	if static is None: static = args.static
 	if args.box[0] == -1:
-		if not args.static:
-			face_det_results = face_detect(frames) # BGR2RGB for CNN face detection
+		if not static:
+			return face_detect(frames, detector) # BGR2RGB for CNN face detection
+		return face_detect([frames[0]], detector)
+
+	print('Using the specified bounding box instead of face detection...')
+	y1, y2, x1, x2 = args.box
+	return [[f[y1: y2, x1:x2], (y1, y2, x1, x2)] for f in frames]
+
+class InputBuffers(object):
+	"""Preallocated NCHW float32 host buffers for the Wav2Lip face and mel inputs, pinned 
+	on cuda so that a batch uploads with one non-blocking copy. Two sets alternate, so the 
+	next batch can be written while the previous one is still being copied."""
+	def __init__(self, batch_size, num_mels, pin_memory=None):
+		if pin_memory is None:
+			pin_memory = device == 'cuda'
+		self.buffers = [(torch.empty((batch_size, 6, args.img_size, args.img_size), pin_memory=pin_memory), 
+						torch.empty((batch_size, 1, num_mels, mel_step_size), pin_memory=pin_memory)) 
+						for _ in range(2)]
+		self.count = 0
+
+	def next(self):
+		"""Returns the (img_batch, mel_batch) tensors to fill next"""
+		self.count += 1
+		return self.buffers[self.count % 2]
+
+def datagen(frames, mels, face_det_results=None, static=None):
+	"""Yields (img_batch, mel_batch, frames, coords) per Wav2Lip batch. The inputs are NCHW 
+	float32 tensors in buffers that are reused two batches later. static tells whether frames 
+	is one still image (default: --static)."""
+	if static is None: static = args.static
+	frame_batch, coords_batch = [], []
+	mels = np.asarray(mels)
+	buffers = InputBuffers(args.wav2lip_batch_size, mels.shape[1])
+	img_batch, mel_batch = buffers.next()
+	start = 0
+
+	if face_det_results is None:
+		face_det_results = get_face_det_results(frames, static=static)
+
+	static_input = None
+	for i in range(len(mels)):
+		idx = 0 if static else i%len(frames)
+		# A static avatar shares its one base frame, the face is pasted into copies downstream
+		frame_to_save = frames[idx] if static else frames[idx].copy()
+		face, coords = face_det_results[idx]
+
+		img = img_batch[i - start].numpy()
+		if static_input is not None:
+			img[...] = static_input
 		else:
-			face_det_results = face_detect([frames[0]])
-	else:
-		print('Using the specified bounding box instead of face detection...')
-		y1, y2, x1, x2 = args.box
-		face_det_results = [[f[y1: y2, x1:x2], (y1, y2, x1, x2)] for f in frames]
-
-	for i, m in enumerate(mels):
-		idx = 0 if args.static else i%len(frames)
-		frame_to_save = frames[idx].copy()
-		face, coords = face_det_results[idx].copy()
-
-		face = cv2.resize(face, (args.img_size, args.img_size))
-			
-		img_batch.append(face)
-		mel_batch.append(m)
-		frame_batch.append(frame_to_save)
-		coords_batch.append(coords)
-
-		if len(img_batch) >= args.wav2lip_batch_size:
-			img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
-
-			img_masked = img_batch.copy()
-			img_masked[:, args.img_size//2:] = 0
-
-			img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
-			mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
+			face = cv2.resize(face, (args.img_size, args.img_size))
 
-			yield img_batch, mel_batch, frame_batch, coords_batch
-			img_batch, mel_batch, frame_batch, coords_batch = [], [], [], []
+			# Channels 3:6 hold the face, 0:3 the face with its lower half masked
+			np.divide(face.transpose(2, 0, 1), 255., out=img[3:])
+			img[:3] = img[3:]
+			img[:3, args.img_size//2:] = 0
+			if static: static_input = img.copy()
 
-	if len(img_batch) > 0:
-		img_batch, mel_batch = np.asarray(img_batch), np.asarray(mel_batch)
-
-		img_masked = img_batch.copy()
-		img_masked[:, args.img_size//2:] = 0
+		frame_batch.append(frame_to_save)
+		coords_batch.append(coords)
 
-		img_batch = np.concatenate((img_masked, img_batch), axis=3) / 255.
-		mel_batch = np.reshape(mel_batch, [len(mel_batch), mel_batch.shape[1], mel_batch.shape[2], 1])
+		if len(frame_batch) >= args.wav2lip_batch_size or i == len(mels) - 1:
+			n = len(frame_batch)
+			mel_batch[:n, 0].numpy()[...] = mels[start:i + 1]
 
-		yield img_batch, mel_batch, frame_batch, coords_batch
+			yield img_batch[:n], mel_batch[:n], frame_batch, coords_batch
+			frame_batch, coords_batch = [], []
+			img_batch, mel_batch = buffers.next()
+			start = i + 1
 
 mel_step_size = 16
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 print('Using {} for inference.'.format(device))
 
+# Face detection batch sizes per resolution, planned from the free memory and kept across calls
+face_det_planner = face_detection.BatchPlanner(device)
+
 def _load(checkpoint_path):
 	if device == 'cuda':
 		checkpoint = torch.load(checkpoint_path)
@@ -178,101 +315,312 @@ def load_model(path):
 	model = model.to(device)
 	return model.eval()
 
-def main():
-	if not os.path.isfile(args.face):
+def read_frames(face_path):
+	if not os.path.isfile(face_path):
 		raise ValueError('--face argument must be a valid path to video/image file')
 
-	elif args.face.split('.')[1] in ['jpg', 'png', 'jpeg']:
-		full_frames = [cv2.imread(args.face)]
-		fps = args.fps
+	elif face_path.split('.')[1] in ['jpg', 'png', 'jpeg']:
+		return [cv2.imread(face_path)], args.fps
 
-	else:
-		video_stream = cv2.VideoCapture(args.face)
-		fps = video_stream.get(cv2.CAP_PROP_FPS)
+	video_stream = cv2.VideoCapture(face_path)
+	fps = video_stream.get(cv2.CAP_PROP_FPS)
 
-		print('Reading video frames...')
+	print('Reading video frames...')
 
-		full_frames = []
-		while 1:
-			still_reading, frame = video_stream.read()
-			if not still_reading:
-				video_stream.release()
-				break
-			if args.resize_factor > 1:
-				frame = cv2.resize(frame, (frame.shape[1]//args.resize_factor, frame.shape[0]//args.resize_factor))
-
-			if args.rotate:
-				frame = cv2.rotate(frame, cv2.cv2.ROTATE_90_CLOCKWISE)
-
-			y1, y2, x1, x2 = args.crop
-			if x2 == -1: x2 = frame.shape[1]
-			if y2 == -1: y2 = frame.shape[0]
+	full_frames = []
+	while 1:
+		still_reading, frame = video_stream.read()
+		if not still_reading:
+			video_stream.release()
+			break
+		if args.resize_factor > 1:
+			frame = cv2.resize(frame, (frame.shape[1]//args.resize_factor, frame.shape[0]//args.resize_factor))
 
-			frame = frame[y1:y2, x1:x2]
+		if args.rotate:
+			frame = cv2.rotate(frame, cv2.cv2.ROTATE_90_CLOCKWISE)
 
-			full_frames.append(frame)
+		y1, y2, x1, x2 = args.crop
+		if x2 == -1: x2 = frame.shape[1]
+		if y2 == -1: y2 = frame.shape[0]
 
-	print ("Number of frames available for inference: "+str(len(full_frames)))
+		frame = frame[y1:y2, x1:x2]
 
-	if not args.audio.endswith('.wav'):
-		print('Extracting raw audio...')
-		command = 'ffmpeg -y -i {} -strict -2 {}'.format(args.audio, 'temp/temp.wav')
+		full_frames.append(frame)
 
-		subprocess.call(command, shell=True)
-		args.audio = 'temp/temp.wav'
+	# A single frame (e.g. a one-frame GIF) is a still image, timed by --fps like the others
+	if len(full_frames) == 1: fps = args.fps
+	return full_frames, fps
 
-	wav = audio.load_wav(args.audio, 16000)
+def get_mel_chunks(wav, fps):
 	mel = audio.melspectrogram(wav)
 	print(mel.shape)
 
 	if np.isnan(mel.reshape(-1)).sum() > 0:
 		raise ValueError('Mel contains nan! Using a TTS voice? Add a small epsilon noise to the wav file and try again')
 
-	mel_chunks = []
-	mel_idx_multiplier = 80./fps 
-	i = 0
-	while 1:
-		start_idx = int(i * mel_idx_multiplier)
-		if start_idx + mel_step_size > len(mel[0]):
-			mel_chunks.append(mel[:, len(mel[0]) - mel_step_size:])
-			break
-		mel_chunks.append(mel[:, start_idx : start_idx + mel_step_size])
-		i += 1
-
-	print("Length of mel chunks: {}".format(len(mel_chunks)))
+	if mel.shape[1] < mel_step_size:
+		raise ValueError('Audio too short, it needs at least {} mel frames'.format(mel_step_size))
 
-	full_frames = full_frames[:len(mel_chunks)]
+	# Chunk i starts at mel frame int(i * 80 / fps), the last one is aligned to the end of mel
+	mel_idx_multiplier = 80./fps 
+	last_idx = mel.shape[1] - mel_step_size
+	# Enough candidates to pass last_idx for any fps, the ones past it are dropped below
+	n_idxs = int(np.ceil((last_idx + 1) / mel_idx_multiplier)) + 1
+	start_idxs = (np.arange(n_idxs) * mel_idx_multiplier).astype(int)
+	start_idxs = np.append(start_idxs[start_idxs <= last_idx], last_idx)
 
-	batch_size = args.wav2lip_batch_size
-	gen = datagen(full_frames.copy(), mel_chunks)
+	# (num_windows, num_mels, mel_step_size) view of mel, gathered into one array of chunks
+	windows = np.lib.stride_tricks.sliding_window_view(mel, mel_step_size, axis=1).transpose(1, 0, 2)
+	mel_chunks = windows[start_idxs]
 
-	for i, (img_batch, mel_batch, frames, coords) in enumerate(tqdm(gen, 
-											total=int(np.ceil(float(len(mel_chunks))/batch_size)))):
-		if i == 0:
-			model = load_model(args.checkpoint_path)
-			print ("Model loaded")
+	print("Length of mel chunks: {}".format(len(mel_chunks)))
+	return mel_chunks
+
+def prepare_avatar(face_path, detector=None, cache_dir='temp', static=None):
+	"""Decodes the face image/video, detects the face in every frame and precomputes the 
+	96x96 crops and the masked 6-channel (NCHW) Wav2Lip inputs. The result is saved in cache_dir,
+	keyed on the file content and the options that change the frames or the detection (--pads, 
+	--resize_factor, --crop, --rotate, --fps, ...), so later calls on the same face skip detection.
+	static tells whether the face is a still image (default: --static), a face that decodes to a 
+	single frame is treated as one whatever its extension."""
+	if static is None: static = args.static
+	with open(face_path, 'rb') as f:
+		key = hashlib.sha1(f.read())
+	key.update(str((list(args.pads), args.nosmooth, static, args.img_size, args.track_every, 
+				args.auto_resize, args.det_face_size, args.refine_detections, args.resize_factor, 
+				list(args.crop), args.rotate, args.fps, 'nchw')).encode())
+	cache_path = os.path.join(cache_dir, 'avatar_{}.npz'.format(key.hexdigest()))
+
+	if os.path.isfile(cache_path):
+		print('Loading cached avatar from: {}'.format(cache_path))
+		with np.load(cache_path) as cached:
+			return {k: cached[k] for k in cached.files}
+
+	full_frames, fps = read_frames(face_path)
+	static = static or len(full_frames) == 1
+	face_det_results = get_face_det_results(full_frames, detector, static)
+	if static: full_frames = full_frames[:1]
+
+	faces = np.asarray([cv2.resize(face, (args.img_size, args.img_size)) for face, _ in face_det_results])
+	img_masked = faces.copy()
+	img_masked[:, args.img_size//2:] = 0
+
+	avatar = {
+		'frames': np.asarray(full_frames),
+		'coords': np.asarray([coords for _, coords in face_det_results], dtype=np.int64),
+		'faces': faces,
+		'inputs': (np.concatenate((img_masked, faces), axis=3).transpose(0, 3, 1, 2) / 255.).astype(np.float32),
+		'fps': np.float64(fps),
+		'static': np.bool_(static),
+	}
+
+	# Written under a unique name first and renamed, so concurrent jobs never load a partial file
+	os.makedirs(cache_dir, exist_ok=True)
+	tmp_path = '{}.{}.tmp.npz'.format(cache_path[:-len('.npz')], uuid.uuid4().hex)
+	try:
+		np.savez(tmp_path, **avatar)
+		os.replace(tmp_path, cache_path)
+	finally:
+		if os.path.exists(tmp_path): os.remove(tmp_path)
+	return avatar
+
+def avatar_datagen(avatar, mels):
+	"""Same batches as datagen, built from the precomputed inputs of prepare_avatar"""
+	static = bool(avatar['static'])
+	mels = np.asarray(mels)
+	buffers = InputBuffers(args.wav2lip_batch_size, mels.shape[1])
+	n_frames = len(avatar['frames'])
+	for start in range(0, len(mels), args.wav2lip_batch_size):
+		idxs = np.arange(start, min(start + args.wav2lip_batch_size, len(mels))) % n_frames
+
+		img_batch, mel_batch = buffers.next()
+		img_batch, mel_batch = img_batch[:len(idxs)], mel_batch[:len(idxs)]
+		np.take(avatar['inputs'], idxs, axis=0, out=img_batch.numpy())
+		mel_batch[:, 0].numpy()[...] = mels[start:start + len(idxs)]
+		frame_batch = [avatar['frames'][idx] if static else avatar['frames'][idx].copy() for idx in idxs]
+		coords_batch = [tuple(avatar['coords'][idx]) for idx in idxs]
 
-			frame_h, frame_w = full_frames[0].shape[:-1]
-			out = cv2.VideoWriter('temp/result.avi', 
-									cv2.VideoWriter_fourcc(*'DIVX'), fps, (frame_w, frame_h))
+		yield img_batch, mel_batch, frame_batch, coords_batch
 
-		img_batch = torch.FloatTensor(np.transpose(img_batch, (0, 3, 1, 2))).to(device)
-		mel_batch = torch.FloatTensor(np.transpose(mel_batch, (0, 3, 1, 2))).to(device)
+def lipsync_faces(model, gen):
+	"""Runs Wav2Lip over the batches of gen and yields (faces, frames, coords) batch by batch, 
+	where the faces are the generated mouth regions, already resized to their coords"""
+	for img_batch, mel_batch, frames, coords in gen:
+		img_batch = img_batch.to(device, non_blocking=True)
+		mel_batch = mel_batch.to(device, non_blocking=True)
 
 		with torch.no_grad():
 			pred = model(mel_batch, img_batch)
 
 		pred = pred.cpu().numpy().transpose(0, 2, 3, 1) * 255.
 		
-		for p, f, c in zip(pred, frames, coords):
+		faces = []
+		for p, c in zip(pred, coords):
 			y1, y2, x1, x2 = c
-			p = cv2.resize(p.astype(np.uint8), (x2 - x1, y2 - y1))
+			faces.append(cv2.resize(p.astype(np.uint8), (x2 - x1, y2 - y1)))
 
+		yield faces, frames, coords
+
+def lipsync_batches(model, gen, static=None):
+	"""Runs Wav2Lip over the batches of gen and yields the composited full frames batch by batch. 
+	static tells whether gen shares one base frame (default: --static)."""
+	if static is None: static = args.static
+	for faces, frames, coords in lipsync_faces(model, gen):
+		if static:
+			frames = [f.copy() for f in frames]
+
+		for p, f, c in zip(faces, frames, coords):
+			y1, y2, x1, x2 = c
 			f[y1:y2, x1:x2] = p
-			out.write(f)
+
+		yield frames
+
+def lipsync_stream(model, gen, fps, wav, sr=16000, static=None):
+	"""Streaming counterpart of render: yields (frames, wav span) one Wav2Lip batch at a time,
+	where the wav span is the part of wav (sampled at sr) played over those frames"""
+	start = 0
+	for frames in lipsync_batches(model, gen, static):
+		end = start + len(frames)
+		yield frames, wav[int(start * sr / fps) : int(end * sr / fps)]
+		start = end
+
+# ffmpeg -movflags per --movflags choice
+MOVFLAGS = {
+	'faststart': ['-movflags', '+faststart'],
+	'fragmented': ['-movflags', '+frag_keyframe+empty_moov+default_base_moof'],
+	'none': [],
+}
+
+class EncoderPipe(object):
+	"""cv2.VideoWriter-like sink that pipes raw BGR frames into one ffmpeg process, which encodes 
+	them to H.264 and muxes in audio_path in the same pass. The MP4 is written under a unique 
+	temporary name next to outfile and renamed once the encode succeeded."""
+	def __init__(self, outfile, fps, size, audio_path=None, movflags='faststart'):
+		frame_w, frame_h = size
+		self.outfile = outfile
+		self.partfile = '{}.{}.part'.format(outfile, uuid.uuid4().hex)
+
+		command = ['ffmpeg', '-y', '-loglevel', 'error', 
+					'-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', '{}x{}'.format(frame_w, frame_h), '-r', str(fps), '-i', '-']
+		if audio_path is not None:
+			command += ['-i', audio_path, '-c:a', 'aac', '-shortest']
+		command += ['-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', 
+					'-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2'] + MOVFLAGS[movflags] + ['-f', 'mp4', self.partfile]
+		self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+	def write(self, frame):
+		try:
+			self.process.stdin.write(np.ascontiguousarray(frame).data)
+		except BrokenPipeError:
+			self.release()
+
+	def release(self):
+		if not self.process.stdin.closed:
+			self.process.stdin.close()
+		if self.process.wait() != 0:
+			if os.path.isfile(self.partfile): os.remove(self.partfile)
+			raise RuntimeError('ffmpeg failed to encode {} (exit code {})'.format(self.outfile, self.process.returncode))
+		os.replace(self.partfile, self.outfile)
+
+	def abort(self):
+		"""Stops ffmpeg and removes the partial output, after a failed render"""
+		self.process.kill()
+		self.process.wait()
+		if not self.process.stdin.closed:
+			try:
+				self.process.stdin.close()
+			except BrokenPipeError:
+				pass
+		if os.path.isfile(self.partfile): os.remove(self.partfile)
+
+def render(model, gen, fps, total=None, outfile='temp/result.avi', audio_path=None, encoder='cv2', 
+			movflags='faststart', static=None):
+	"""Runs Wav2Lip over the batches of gen and writes the lip-synced frames to outfile, either 
+	as a silent DIVX AVI (encoder='cv2') or as an MP4 with audio_path muxed in (encoder='ffmpeg').
+	A static avatar is composited in a single copy of its base frame, of which only the face 
+	region changes from frame to frame (static, default: --static)."""
+	if static is None: static = args.static
+	canvas, out = None, None
+	try:
+		for i, (faces, frames, coords) in enumerate(tqdm(lipsync_faces(model, gen), total=total)):
+			if i == 0:
+				frame_h, frame_w = frames[0].shape[:-1]
+				if encoder == 'ffmpeg':
+					out = EncoderPipe(outfile, fps, (frame_w, frame_h), audio_path, movflags)
+				else:
+					out = cv2.VideoWriter(outfile, 
+											cv2.VideoWriter_fourcc(*'DIVX'), fps, (frame_w, frame_h))
+
+			for p, f, c in zip(faces, frames, coords):
+				if static:
+					if canvas is None: canvas = f.copy()
+					f = canvas
+
+				y1, y2, x1, x2 = c
+				f[y1:y2, x1:x2] = p
+				out.write(f)
+	except BaseException:
+		# Never leave an ffmpeg process or a partial MP4 behind
+		if isinstance(out, EncoderPipe):
+			out.abort()
+		elif out is not None:
+			out.release()
+		raise
 
 	out.release()
-	combine_audio("temp/result.avi", args.audio, args.outfile)
+	return outfile
+
+def write_video(model, gen, fps, audio_path, outfile, total=None, workspace=None, static=None):
+	"""Renders gen with the audio of audio_path into results/outfile, with the --encoder backend.
+	The moviepy backend writes its intermediate AVI into workspace (a new one if None)."""
+	if args.encoder == 'ffmpeg':
+		return render(model, gen, fps, total, path.join('results', outfile), audio_path, 
+						encoder='ffmpeg', movflags=args.movflags, static=static)
+
+	if workspace is None:
+		with Workspace(args.temp_dir, ram=args.ram_temp) as workspace:
+			return write_video(model, gen, fps, audio_path, outfile, total, workspace, static)
+
+	video = workspace.path('result.avi')
+	render(model, gen, fps, total, video, static=static)
+	combine_audio(video, audio_path, outfile)
+	return path.join('results', outfile)
+
+def main():
+	if args.avatar_cache_dir is not None and args.box[0] == -1:
+		avatar = prepare_avatar(args.face, cache_dir=args.avatar_cache_dir)
+		full_frames, fps = list(avatar['frames']), float(avatar['fps'])
+		static = bool(avatar['static'])
+	else:
+		avatar = None
+		full_frames, fps = read_frames(args.face)
+		static = args.static or len(full_frames) == 1
+
+	print ("Number of frames available for inference: "+str(len(full_frames)))
+
+	with Workspace(args.temp_dir, ram=args.ram_temp) as job:
+		audio_path = args.audio
+		if not audio_path.endswith('.wav'):
+			print('Extracting raw audio...')
+			audio_path = job.path('temp.wav')
+			command = 'ffmpeg -y -i {} -strict -2 {}'.format(args.audio, audio_path)
+
+			subprocess.call(command, shell=True)
+
+		wav = audio.load_wav(audio_path, 16000)
+		mel_chunks = get_mel_chunks(wav, fps)
+
+		if avatar is not None:
+			gen = avatar_datagen(avatar, mel_chunks)
+		else:
+			full_frames = full_frames[:len(mel_chunks)]
+			gen = datagen(full_frames.copy(), mel_chunks, get_face_det_results(full_frames, static=static), static)
+
+		model = load_model(args.checkpoint_path)
+		print ("Model loaded")
+
+		write_video(model, gen, fps, audio_path, args.outfile, 
+					total=int(np.ceil(float(len(mel_chunks))/args.wav2lip_batch_size)), workspace=job, static=static)
 
 def combine_audio(video, audio, out, fps=60):
 	import moviepy.editor as mpe
@@ -0,0 +1,228 @@
+import os
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from queue import Queue, Empty
+from threading import Lock, Thread
+import numpy as np
+import torch
+import librosa
+from scipy.io import wavfile
+import face_detection
+import inference
+from workspace import Workspace
+from hparams import hparams as hp
+
+class LipSyncEngine:
+	"""Long-lived, in-process Wav2Lip renderer.
+
+	Loads the Wav2Lip checkpoint and the S3FD face detector once, so that every
+	chat turn only pays for mel extraction, face detection and the forward passes,
+	instead of a fresh interpreter running inference.py.
+
+	Renders running in several threads at once share the Wav2Lip forward passes
+	through a LipSyncScheduler. Whether a face is a still image is passed along with
+	each job, so image and video faces can be rendered at the same time.
+
+	Example::
+
+		engine = LipSyncEngine('checkpoints/wav2lip.pth')
+		engine(wav, 'input_image.gif', 'output_0_video.mp4')
+	"""
+
+	def __init__(self, checkpoint_path='checkpoints/wav2lip.pth', cache_dir='temp', batch_window=0.01, 
+				avatar_cache_size=4, **options):
+		"""
+		Args:
+			checkpoint_path (str): Wav2Lip checkpoint to load
+			cache_dir (str): folder for the precomputed avatars of inference.prepare_avatar
+			avatar_cache_size (int): number of loaded avatars kept in memory, the least recently 
+				used one is dropped first
+			batch_window (float): seconds the LipSyncScheduler waits for other jobs to fill 
+				an incomplete Wav2Lip batch
+			**options: overrides for the inference.py CLI options (e.g. pads, nosmooth,
+				face_det_batch_size, wav2lip_batch_size, fps, encoder, movflags, temp_dir, ram_temp)
+		"""
+		for key, value in options.items():
+			setattr(inference.args, key, value)
+		self.cache_dir = cache_dir
+		self.avatar_cache_size = avatar_cache_size
+		self.avatars = OrderedDict()
+		self.avatars_lock = Lock()
+
+		self.model = inference.load_model(checkpoint_path)
+		self.scheduler = LipSyncScheduler(self.model, inference.args.wav2lip_batch_size, batch_window)
+		self.detector = face_detection.FaceAlignment(face_detection.LandmarksType._2D,
+													flip_input=False, device=inference.device)
+
+	def load_face(self, face):
+		"""Returns (avatar, fps, static) for a face source, where static tells whether it is
+		a still image, i.e. a single frame (also e.g. a one-frame GIF). Paths go through the avatar
+		cache of inference.prepare_avatar and are then kept in memory until the file changes, lists 
+		of BGR frames are detected on every call."""
+		if isinstance(face, str):
+			avatar = self.load_avatar(face)
+			return avatar, float(avatar['fps']), bool(avatar['static'])
+
+		return None, inference.args.fps, len(face) == 1
+
+	def load_avatar(self, face_path):
+		"""Returns the precomputed avatar of a face file, from memory unless the file changed"""
+		static = face_path.split('.')[1] in ['jpg', 'png', 'jpeg']
+		stat = os.stat(face_path)
+		key = (os.path.abspath(face_path), stat.st_mtime_ns, stat.st_size, static)
+		with self.avatars_lock:
+			if key in self.avatars:
+				self.avatars.move_to_end(key)
+				return self.avatars[key]
+
+		avatar = inference.prepare_avatar(face_path, self.detector, cache_dir=self.cache_dir, static=static)
+		with self.avatars_lock:
+			self.avatars[key] = avatar
+			while len(self.avatars) > self.avatar_cache_size:
+				self.avatars.popitem(last=False)
+		return avatar
+
+	def batches(self, wav, face):
+		"""Returns (Wav2Lip batch generator, fps, static) for 16 kHz float speech and a face source"""
+		avatar, fps, static = self.load_face(face)
+		mel_chunks = inference.get_mel_chunks(wav, fps)
+
+		if avatar is not None:
+			return inference.avatar_datagen(avatar, mel_chunks), fps, static
+
+		full_frames = list(face)[:len(mel_chunks)]
+		face_det_results = inference.get_face_det_results(full_frames, self.detector, static)
+		return inference.datagen(full_frames, mel_chunks, face_det_results, static), fps, static
+
+	def __call__(self, wav, face, outfile, sr=hp.sample_rate, audio_path=None, workspace=None):
+		"""Renders a lip-synced MP4 for the given speech.
+
+		Args:
+			wav (np.ndarray): mono speech, float in [-1, 1] or int16 PCM
+			face: path to the face image/video, or a list of BGR frames
+			outfile (str): file name of the result, written into results/
+			sr (int): sampling rate of wav, resampled to hparams.sample_rate if needed
+			audio_path (str): existing audio file to mux into the video. If None, wav is
+				written into the workspace first.
+			workspace (Workspace): scratch folder of the job. If None, a new one is created
+				(see the temp_dir and ram_temp options) and removed afterwards.
+
+		Returns:
+			str: outfile
+		"""
+		if workspace is None:
+			with Workspace(inference.args.temp_dir, ram=inference.args.ram_temp) as workspace:
+				return self(wav, face, outfile, sr, audio_path, workspace)
+
+		wav = to_model_rate(wav, sr)
+
+		if audio_path is None:
+			audio_path = workspace.path('speech.wav')
+			wavfile.write(audio_path, hp.sample_rate, (np.clip(wav, -1., 1.) * 32767).astype(np.int16))
+
+		gen, fps, static = self.batches(wav, face)
+		inference.write_video(self.scheduler, gen, fps, audio_path, outfile, workspace=workspace, static=static)
+		return outfile
+
+	def stream(self, wav, face, sr=hp.sample_rate):
+		"""Streaming variant of __call__, nothing is written to disk.
+
+		Yields one item per Wav2Lip batch, as soon as the batch is rendered:
+			(list of BGR frames, float32 wav span at sr played over those frames, fps)
+		"""
+		wav = to_float(wav)
+		gen, fps, static = self.batches(to_model_rate(wav, sr), face)
+		for frames, wav_span in inference.lipsync_stream(self.scheduler, gen, fps, wav, sr, static):
+			yield frames, wav_span, fps
+
+class LipSyncScheduler:
+	"""Packs the (mel, face) pairs of concurrent jobs into shared Wav2Lip batches.
+
+	Called like the model, scheduler(mel_batch, img_batch), from any number of job
+	threads. The calls block while a single worker thread fills batches of up to
+	batch_size pairs from all pending jobs (splitting a job's pairs over batches if
+	needed), runs the model once per batch and hands every job its own predictions.
+	An incomplete batch waits at most window seconds for more jobs.
+	"""
+
+	def __init__(self, model, batch_size=128, window=0.01):
+		self.model = model
+		self.batch_size = batch_size
+		self.window = window
+		self.requests = Queue()
+		Thread(target=self.run, daemon=True).start()
+
+	def __call__(self, mel_batch, img_batch):
+		request = _Request(mel_batch, img_batch)
+		self.requests.put(request)
+		return request.result.result()
+
+	def run(self):
+		pending = deque()
+		while True:
+			if not pending:
+				pending.append(self.requests.get())
+			deadline = time.monotonic() + self.window
+			while sum(request.remaining for request in pending) < self.batch_size:
+				try:
+					pending.append(self.requests.get(timeout=max(0, deadline - time.monotonic())))
+				except Empty:
+					break
+
+			# (request, number of pairs) in the next batch, oldest requests first
+			parts, size = [], 0
+			for request in pending:
+				count = min(request.remaining, self.batch_size - size)
+				parts.append((request, count))
+				size += count
+				if size == self.batch_size:
+					break
+
+			try:
+				mel_batch = torch.cat([request.mel_batch[request.done:request.done + count] for request, count in parts])
+				img_batch = torch.cat([request.img_batch[request.done:request.done + count] for request, count in parts])
+				with torch.no_grad():
+					pred = self.model(mel_batch, img_batch)
+			except Exception as e:
+				for request, _ in parts:
+					request.result.set_exception(e)
+					pending.remove(request)
+				continue
+
+			start = 0
+			for request, count in parts:
+				request.outputs.append(pred[start:start + count])
+				request.done += count
+				start += count
+				if request.remaining == 0:
+					request.result.set_result(torch.cat(request.outputs))
+					pending.remove(request)
+
+class _Request:
+	"""Wav2Lip inputs of one job batch and its predictions so far"""
+
+	def __init__(self, mel_batch, img_batch):
+		self.mel_batch = mel_batch
+		self.img_batch = img_batch
+		self.done = 0
+		self.outputs = []
+		self.result = Future()
+
+	@property
+	def remaining(self):
+		return len(self.mel_batch) - self.done
+
+def to_float(wav):
+	"""Mono float32 speech in [-1, 1] from a float or int16 PCM array"""
+	wav = np.asarray(wav)
+	if wav.dtype == np.int16:
+		wav = wav.astype(np.float32) / 32768.
+	return np.squeeze(wav).astype(np.float32)
+
+def to_model_rate(wav, sr):
+	"""to_float, resampled from sr to the Wav2Lip rate (hparams.sample_rate)"""
+	wav = to_float(wav)
+	if sr != hp.sample_rate:
+		wav = librosa.resample(wav, orig_sr=sr, target_sr=hp.sample_rate)
+	return wav
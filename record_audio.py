@@ -3,11 +3,19 @@ os.environ['KMP_DUPLICATE_LIB_OK'] = 'TRUE'
 import pyaudio
 import speech_recognition as sr
 import wave
+import numpy as np
+from threading import Thread
 #from emo_detect.EmotionRecognitionModel import EmotionRecognitionModel
-from emo_detect.load_model import predict
+from emo_detect.load_model import get_predictor
 
-def record_audio(duration: int, filename: str) -> tuple:
-    """Records audio of duration 'duration' and saves it in file 'filename'. Returns a (filename, text, emotion)"""
+def record_audio(duration: int, filename: str = None, stop_on_silence: bool = False, silence_duration: float = 1.0,
+                 silence_threshold: float = 500, on_progress=None) -> tuple:
+    """Records audio of duration 'duration' and transcribes it straight from memory. If 'filename' is given,
+    the recording is also archived there by a background thread. Returns a (filename, text, emotion)
+
+    With 'stop_on_silence', 'duration' is the maximum: the recording ends once the speaker has been silent
+    (RMS of a chunk below 'silence_threshold') for 'silence_duration' seconds after speaking.
+    'on_progress' is called with (seconds recorded, duration) after every chunk."""
     # Set up parameters for recording
     chunk = 1024  # Record in chunks of 1024 samples
     sample_format = pyaudio.paInt16  # 16 bits per sample
@@ -26,35 +34,59 @@ def record_audio(duration: int, filename: str) -> tuple:
                     input=True)
 
     frames = []  # Initialize array to store frames
+    speech_started = False
+    silent_chunks = 0
+    max_silent_chunks = int(rate / chunk * silence_duration)
 
     # Store data in chunks for the specified duration
-    for _ in range(0, int(rate / chunk * duration)):
+    for i in range(0, int(rate / chunk * duration)):
         data = stream.read(chunk)
         frames.append(data)
+        if on_progress is not None:
+            on_progress((i + 1) * chunk / rate, duration)
+
+        if stop_on_silence:
+            samples = np.frombuffer(data, dtype=np.int16).astype(np.float32)
+            if np.sqrt(np.mean(samples ** 2)) >= silence_threshold:
+                speech_started = True
+                silent_chunks = 0
+            elif speech_started:
+                silent_chunks += 1
+                if silent_chunks > max_silent_chunks:
+                    break
 
     # Stop and close the stream
     stream.stop_stream()
     stream.close()
 
+    sample_width = p.get_sample_size(sample_format)
+
     # Terminate the PortAudio interface
     p.terminate()
 
     print("Recording finished.")
 
+    pcm = b''.join(frames)
+    if filename is not None:
+        Thread(target=save_wav, args=(filename, pcm, channels, sample_width, rate)).start()
+
+    text, emotion = transcribe_audio_data(sr.AudioData(pcm, rate, sample_width))
+    return filename, text, emotion
+
+def save_wav(filename: str, pcm: bytes, channels: int, sample_width: int, rate: int):
+    """Archives a recording as a WAV file"""
     # Ensure the directory exists
     os.makedirs(os.path.dirname(filename), exist_ok=True)
 
     # Save the recorded data as a WAV file
     with wave.open(filename, 'wb') as wf:
         wf.setnchannels(channels)
-        wf.setsampwidth(p.get_sample_size(sample_format))
+        wf.setsampwidth(sample_width)
         wf.setframerate(rate)
-        wf.writeframes(b''.join(frames))
-        text, emotion = transcribe_audio(filename)
-    return filename, text, emotion
+        wf.writeframes(pcm)
 
 def transcribe_audio(filename: str) -> tuple:
-    """Transscribes the audio, and makes emotion prediction, returns (text, emotion)"""
+    """Transscribes the audio file, and makes emotion prediction, returns (text, emotion)"""
     # Initialize recognizer
     recognizer = sr.Recognizer()
 
@@ -62,11 +94,20 @@ def transcribe_audio(filename: str) -> tuple:
     with sr.AudioFile(filename) as source:
         audio_data = recognizer.record(source)  # Read the entire audio file
 
+    return transcribe_audio_data(audio_data)
+
+def transcribe_audio_data(audio_data: sr.AudioData) -> tuple:
+    """Transscribes the in-memory audio, and makes emotion prediction on the same samples, returns (text, emotion)"""
+    # Initialize recognizer
+    recognizer = sr.Recognizer()
+
     # Recognize (convert from speech to text)
     try:
         text = recognizer.recognize_google(audio_data)
         print("Transcription: " + text)
-        emotion = predict(filename)
+        # 16 bit mono PCM to float, the predictor resamples it once to its own rate
+        signal = np.frombuffer(audio_data.get_raw_data(convert_width=2), dtype=np.int16).astype(np.float32) / 32768.
+        emotion = get_predictor().predict(signal, audio_data.sample_rate)
         return text, emotion
     except sr.UnknownValueError:
         print("Google Speech Recognition could not understand the audio")
@@ -0,0 +1,315 @@
+import os
+os.environ['KMP_DUPLICATE_LIB_OK'] = 'TRUE'
+import argparse
+import asyncio
+import base64
+import json
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from aiohttp import web
+from scipy.io import wavfile
+import LLMAccess
+import emotionalFace
+import emotion_text_detect.load_text_model as text_oracle
+from workspace import Workspace
+
+parser = argparse.ArgumentParser(description='HTTP/WebSocket chat server around the emotionalFace pipeline')
+parser.add_argument('--host', type=str, default='0.0.0.0')
+parser.add_argument('--port', type=int, default=8080)
+parser.add_argument('--max_pending', type=int, default=16,
+                    help='Turns that may wait in the request queue, further requests are rejected as busy')
+parser.add_argument('--max_active', type=int, default=4,
+                    help='Turns processed at the same time, their stages share the worker pools')
+parser.add_argument('--outbox_size', type=int, default=8,
+                    help='Messages buffered per turn before a slow client pauses its pipeline')
+parser.add_argument('--llm_workers', type=int, default=8, help='Threads waiting on LLM responses')
+parser.add_argument('--tts_workers', type=int, default=8,
+                    help='Turns synthesizing speech at the same time, batched by emotionalFace.speech_batcher')
+parser.add_argument('--lipsync_workers', type=int, default=4,
+                    help='Turns lip-syncing at the same time, their frames share the Wav2Lip batches')
+parser.add_argument('--jpeg_quality', type=int, default=80, help='JPEG quality of the streamed frames')
+
+# The talking face of every session
+FACE = "input_image.gif"
+
+class Stages:
+    """
+    One thread pool per pipeline stage. The models are loaded once (by emotionalFace) and shared by
+    all sessions, the pool sizes bound how many turns use a stage at the same time. The TTS and
+    lip-sync workers of concurrent turns are batched together by emotionalFace.speech_batcher and
+    the LipSyncScheduler of the engine.
+    """
+    def __init__(self, llm_workers=8, tts_workers=8, lipsync_workers=4):
+        self.emotion = ThreadPoolExecutor(1, thread_name_prefix="emotion")
+        self.llm = ThreadPoolExecutor(llm_workers, thread_name_prefix="llm")
+        self.tts = ThreadPoolExecutor(tts_workers, thread_name_prefix="tts")
+        self.lipsync = ThreadPoolExecutor(lipsync_workers, thread_name_prefix="lipsync")
+
+    def shutdown(self):
+        for pool in (self.emotion, self.llm, self.tts, self.lipsync):
+            pool.shutdown(wait=False)
+
+async def run(pool, fn, *args):
+    """Runs fn(*args) in a stage pool"""
+    return await asyncio.get_running_loop().run_in_executor(pool, fn, *args)
+
+async def iterate(pool, iterator):
+    """Advances a blocking iterator in a stage pool, one item per call"""
+    done = object()
+    while True:
+        item = await run(pool, next, iterator, done)
+        if item is done:
+            return
+        yield item
+
+class Turn:
+    """
+    One chat turn of a session. The pipeline puts its messages into the bounded outbox, the
+    connection handler sends them to the client, so a slow client pauses its own turn only.
+    """
+    def __init__(self, text: str, emotion: str = "", outbox_size: int = 8):
+        self.text = text
+        self.emotion = emotion
+        self.outbox = asyncio.Queue(maxsize=outbox_size)
+        self.task = None
+        self.cancelled = False
+
+    async def send(self, message: dict):
+        """Queues a message for the client, dropped once the turn is cancelled"""
+        if not self.cancelled:
+            await self.outbox.put(message)
+
+    async def messages(self):
+        """Yields the messages of the turn until it is finished"""
+        while True:
+            message = await self.outbox.get()
+            if message is None:
+                return
+            yield message
+
+    def cancel(self):
+        """Stops the turn, e.g. when the client disconnected"""
+        self.cancelled = True
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+
+class ChatServer:
+    """
+    Runs the turns of all sessions: emotion detection, LLM, TTS and lip-sync.
+
+    Turns wait in a bounded request queue, which rejects new turns when full, and max_active of them
+    are processed at a time. Within a turn, the speech of the next sentence is synthesized while the
+    current one is lip-synced, like emotionalFace.pipeline_animation.
+
+    Messages (JSON) of a turn, in order:
+        {"type": "emotion", "emotion": str}
+        {"type": "sentence", "text": str}, as soon as the LLM finished the sentence
+        {"type": "batch", "fps": float, "sample_rate": int, "frames": [base64 JPEG],
+            "audio": base64 int16 PCM}, one per Wav2Lip batch
+        {"type": "error", "message": str}, if the turn failed
+        {"type": "done"}
+    """
+    def __init__(self, stages: Stages, max_pending=16, max_active=4, outbox_size=8, jpeg_quality=80):
+        self.stages = stages
+        self.max_pending = max_pending
+        self.max_active = max_active
+        self.outbox_size = outbox_size
+        self.jpeg_quality = jpeg_quality
+        self.requests = None
+        self.workers = []
+        self.active = 0
+
+    async def start(self, app=None):
+        self.requests = asyncio.Queue(maxsize=self.max_pending)
+        self.workers = [asyncio.create_task(self.worker()) for _ in range(self.max_active)]
+
+    async def stop(self, app=None):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.stages.shutdown()
+
+    def submit(self, text: str, emotion: str = ""):
+        """
+        @return: the queued Turn, or None if the request queue is full
+        """
+        turn = Turn(text, emotion, self.outbox_size)
+        try:
+            self.requests.put_nowait(turn)
+        except asyncio.QueueFull:
+            return None
+        return turn
+
+    async def worker(self):
+        while True:
+            turn = await self.requests.get()
+            if turn.cancelled:
+                continue
+            self.active += 1
+            turn.task = asyncio.create_task(self.process(turn))
+            await asyncio.wait([turn.task])
+            self.active -= 1
+
+    async def process(self, turn: Turn):
+        """
+        Runs a turn and ends its messages. The closing messages are sent by the turn task as well,
+        so Turn.cancel() also stops a turn waiting on the outbox of a disconnected client.
+        """
+        try:
+            await self.run_turn(turn)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await turn.send({"type": "error", "message": str(e)})
+        await turn.send({"type": "done"})
+        await turn.send(None)
+
+    async def run_turn(self, turn: Turn):
+        emotion = turn.emotion
+        if not emotion:
+            emotion = await run(self.stages.emotion, text_oracle.predict_emotion, turn.text, emotionalFace.device)
+        await turn.send({"type": "emotion", "emotion": emotion})
+
+        key = LLMAccess.cache_key(turn.text, emotion)
+        cached = emotionalFace.cached_turn(key)
+        speech = asyncio.Queue(maxsize=emotionalFace.PIPELINE_QUEUE_SIZE)
+        spoken, wavs = [], []
+
+        async def synthesize():
+            cancelled = False
+            try:
+                if cached is not None:
+                    for sentence in LLMAccess.split_sentences(cached["response"]):
+                        await turn.send({"type": "sentence", "text": sentence})
+                    sampling_rate, wav = await run(self.stages.llm, wavfile.read, cached["audio_file"])
+                    await speech.put((wav, sampling_rate))
+                    return
+                sentences = LLMAccess.stream_sentences(turn.text, emotion)
+                async for sentence in iterate(self.stages.llm, sentences):
+                    await turn.send({"type": "sentence", "text": sentence})
+                    spoken.append(sentence)
+                    wav = await run(self.stages.tts, emotionalFace.generate_speech, sentence, emotion)
+                    wavs.append(wav)
+                    await speech.put((wav, emotionalFace.model.config.sampling_rate))
+            except asyncio.CancelledError:
+                cancelled = True
+                raise
+            finally:
+                # A cancelled producer has no consumer left, which could block on a full queue
+                if not cancelled:
+                    await speech.put(None)
+
+        producer = asyncio.create_task(synthesize())
+        try:
+            while True:
+                item = await speech.get()
+                if item is None:
+                    break
+                async for message in iterate(self.stages.lipsync, self.batch_messages(*item)):
+                    await turn.send(message)
+            await producer
+        finally:
+            producer.cancel()
+
+        if cached is None and wavs:
+            await run(self.stages.llm, store_turn, key, " ".join(spoken), wavs)
+
+    def batch_messages(self, wav, sampling_rate):
+        """Lip-syncs wav and yields a batch message per Wav2Lip batch (runs in the lip-sync pool)"""
+        params = [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality]
+        for frames, wav_span, fps in emotionalFace.lipsync_engine.stream(wav, FACE, sr=sampling_rate):
+            pcm = (np.clip(wav_span, -1., 1.) * 32767).astype(np.int16)
+            yield {
+                "type": "batch",
+                "fps": fps,
+                "sample_rate": int(sampling_rate),
+                "frames": [base64.b64encode(cv2.imencode(".jpg", f, params)[1]).decode() for f in frames],
+                "audio": base64.b64encode(pcm.tobytes()).decode(),
+            }
+
+def store_turn(key: str, response: str, wavs: list):
+    """Stores the response and speech of a finished turn in emotionalFace.artifact_cache"""
+    with Workspace() as job:
+        audio_file = job.path("speech.wav")
+        wavfile.write(audio_file, emotionalFace.model.config.sampling_rate, np.concatenate(wavs, axis=1).T)
+        emotionalFace.cache_turn(key, response, audio_file)
+
+def parse_request(data: dict):
+    """
+    @return: (text, emotion) of a chat request {"text": str, "emotion": str (optional)}
+    """
+    text = str(data.get("text", "")).strip()
+    if not text:
+        raise ValueError("missing text")
+    return text, str(data.get("emotion", ""))
+
+async def chat(request: web.Request):
+    """POST /chat: runs one turn and streams its messages as newline delimited JSON"""
+    server = request.app["server"]
+    try:
+        text, emotion = parse_request(await request.json())
+    except ValueError as e:
+        return web.json_response({"type": "error", "message": str(e)}, status=400)
+    turn = server.submit(text, emotion)
+    if turn is None:
+        return web.json_response({"type": "error", "message": "busy"}, status=503, headers={"Retry-After": "1"})
+
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+    try:
+        async for message in turn.messages():
+            await response.write((json.dumps(message) + "\n").encode())
+    finally:
+        turn.cancel()
+    await response.write_eof()
+    return response
+
+async def session(request: web.Request):
+    """GET /ws: a chat session, every text message is a chat request, its turn is streamed back"""
+    server = request.app["server"]
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+    async for msg in ws:
+        if msg.type != web.WSMsgType.TEXT:
+            continue
+        try:
+            text, emotion = parse_request(json.loads(msg.data))
+        except ValueError as e:
+            await ws.send_json({"type": "error", "message": str(e)})
+            continue
+        turn = server.submit(text, emotion)
+        if turn is None:
+            await ws.send_json({"type": "error", "message": "busy"})
+            continue
+        try:
+            async for message in turn.messages():
+                await ws.send_json(message)
+        finally:
+            turn.cancel()
+    return ws
+
+async def status(request: web.Request):
+    """GET /status: load of the server and the LLM cache counters"""
+    server = request.app["server"]
+    return web.json_response({
+        "pending": server.requests.qsize(),
+        "active": server.active,
+        "llm_cache": {"hits": LLMAccess.response_cache.hits, "misses": LLMAccess.response_cache.misses},
+    })
+
+def create_app(args) -> web.Application:
+    stages = Stages(args.llm_workers, args.tts_workers, args.lipsync_workers)
+    server = ChatServer(stages, args.max_pending, args.max_active, args.outbox_size, args.jpeg_quality)
+    app = web.Application()
+    app["server"] = server
+    app.on_startup.append(server.start)
+    app.on_cleanup.append(server.stop)
+    app.router.add_post("/chat", chat)
+    app.router.add_get("/ws", session)
+    app.router.add_get("/status", status)
+    return app
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    web.run_app(create_app(args), host=args.host, port=args.port)
@@ -0,0 +1,93 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+pytest.importorskip('librosa')
+torch = pytest.importorskip('torch')
+
+import audio
+from hparams import hparams as hp
+
+
+@pytest.fixture(params=['reflect', 'constant'])
+def pad_mode(request):
+	previous = hp.stft_pad_mode
+	hp.set_hparam('stft_pad_mode', request.param)
+	yield request.param
+	hp.set_hparam('stft_pad_mode', previous)
+
+
+def random_batch(lengths, seed=0):
+	rng = np.random.RandomState(seed)
+	wavs = np.zeros((len(lengths), max(lengths)), dtype=np.float32)
+	for i, length in enumerate(lengths):
+		t = np.arange(length)
+		wavs[i, :length] = 0.1 * rng.randn(length) * np.sin(t / 300.) + 0.3 * np.sin(t * 0.05)
+	return wavs
+
+
+@pytest.mark.parametrize('batch_fn, reference_fn, atol', [
+	(audio.melspectrogram_batch, audio.melspectrogram, 1e-4),
+	(audio.linearspectrogram_batch, audio.linearspectrogram, 2e-3),
+])
+def test_batch_matches_librosa(pad_mode, batch_fn, reference_fn, atol):
+	# Unequal lengths, including ones that are not a multiple of the hop size and ones shorter
+	# than n_fft // 2 + 1, whose reflect padding repeats
+	lengths = [16000, 12345, 40000, 801, 300, 2, 1]
+	wavs = random_batch(lengths)
+
+	S, num_frames = batch_fn(wavs, lengths)
+	S = S.numpy()
+	for i, length in enumerate(lengths):
+		reference = reference_fn(wavs[i, :length])
+		assert int(num_frames[i]) == reference.shape[1]
+		np.testing.assert_allclose(S[i, :, :num_frames[i]], reference, atol=atol)
+		# The edge frames depend on the padding
+		edge = min(2, reference.shape[1])
+		np.testing.assert_allclose(S[i, :, :edge], reference[:, :edge], atol=atol)
+		np.testing.assert_allclose(S[i, :, num_frames[i] - edge:num_frames[i]], reference[:, -edge:], atol=atol)
+		assert not S[i, :, num_frames[i]:].any()
+
+
+def test_batch_empty_row():
+	wavs = random_batch([1000, 1])
+	S, num_frames = audio.melspectrogram_batch(wavs, [1000, 0])
+	assert num_frames.tolist() == [1000 // audio.get_hop_size() + 1, 1]
+	np.testing.assert_allclose(S[0, :, :num_frames[0]].numpy(), audio.melspectrogram(wavs[0]), atol=1e-4)
+
+
+def test_batch_without_lengths():
+	wavs = random_batch([8000, 8000])
+	S, num_frames = audio.melspectrogram_batch(wavs)
+	assert S.shape == (2, hp.num_mels, 8000 // audio.get_hop_size() + 1)
+	np.testing.assert_allclose(S[0].numpy(), audio.melspectrogram(wavs[0]), atol=1e-4)
+
+
+def stream_mel(wav, chunk_sizes):
+	stream = audio.MelStream()
+	outputs, start = [], 0
+	for size in chunk_sizes:
+		outputs.append(stream.feed(wav[start:start + size]))
+		start += size
+	outputs.append(stream.feed(wav[start:]))
+	outputs.append(stream.finish())
+	return np.concatenate(outputs, axis=1)
+
+
+@pytest.mark.parametrize('length', [300, 401, 1000, 16123])
+def test_stream_matches_melspectrogram(pad_mode, length):
+	wav = random_batch([length], seed=length)[0]
+	reference = audio.melspectrogram(wav)
+	rng = np.random.RandomState(length)
+	for chunk_sizes in ([], [1] * 50, [0, 7, 0, 199, 3], list(rng.randint(0, length // 4 + 1, size=6))):
+		S = stream_mel(wav, chunk_sizes)
+		assert S.shape == reference.shape
+		np.testing.assert_allclose(S, reference, atol=1e-5)
+
+
+def test_stream_empty_chunk():
+	stream = audio.MelStream()
+	assert stream.feed(np.zeros(0, dtype=np.float32)).shape == (hp.num_mels, 0)
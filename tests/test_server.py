@@ -0,0 +1,92 @@
+import asyncio
+import importlib
+import os
+import sys
+import time
+import types
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+pytest.importorskip('aiohttp')
+pytest.importorskip('cv2')
+
+
+@pytest.fixture
+def server(monkeypatch):
+	"""server.py with stand-ins for the model modules, the turns only go through the pipeline"""
+	llm = types.ModuleType('LLMAccess')
+	llm.cache_key = lambda text, emotion: 'key'
+	llm.stream_sentences = lambda text, emotion: iter(['Sentence {}.'.format(i) for i in range(8)])
+
+	face = types.ModuleType('emotionalFace')
+	face.device = 'cpu'
+	face.PIPELINE_QUEUE_SIZE = 1
+	face.cached_turn = lambda key: None
+	face.generate_speech = lambda text, emotion: np.zeros((1, 16), dtype=np.int16)
+	face.model = types.SimpleNamespace(config=types.SimpleNamespace(sampling_rate=16000))
+
+	oracle = types.ModuleType('emotion_text_detect.load_text_model')
+	package = types.ModuleType('emotion_text_detect')
+	package.load_text_model = oracle
+
+	monkeypatch.setitem(sys.modules, 'LLMAccess', llm)
+	monkeypatch.setitem(sys.modules, 'emotionalFace', face)
+	monkeypatch.setitem(sys.modules, 'emotion_text_detect', package)
+	monkeypatch.setitem(sys.modules, 'emotion_text_detect.load_text_model', oracle)
+	monkeypatch.delitem(sys.modules, 'server', raising=False)
+	return importlib.import_module('server')
+
+
+def test_disconnect_with_full_outbox_frees_worker(server):
+	async def run_turn(turn):
+		# Fills the outbox, the closing messages then wait for a client that never reads them
+		await turn.send({'type': 'sentence', 'text': turn.text})
+
+	async def main():
+		chat = server.ChatServer(server.Stages(1, 1, 1), max_active=1, outbox_size=1)
+		chat.run_turn = run_turn
+		await chat.start()
+		try:
+			first = chat.submit('first')
+			await asyncio.sleep(0.1)
+			first.cancel()
+
+			second = chat.submit('second')
+			messages = await asyncio.wait_for(collect(second), timeout=5)
+			assert messages == [{'type': 'sentence', 'text': 'second'}, {'type': 'done'}]
+		finally:
+			await chat.stop()
+
+	asyncio.run(main())
+
+
+def test_failed_lipsync_does_not_leave_producer_blocked(server):
+	def batch_messages(wav, sampling_rate):
+		# Lets the producer fill the speech queue before the turn fails
+		time.sleep(0.2)
+		raise ValueError('lip-sync failed')
+		yield
+
+	async def main():
+		chat = server.ChatServer(server.Stages(1, 1, 1), max_active=1, outbox_size=64)
+		chat.batch_messages = batch_messages
+		await chat.start()
+		try:
+			turn = chat.submit('hello', 'neutral')
+			messages = await asyncio.wait_for(collect(turn), timeout=5)
+			assert messages[-2:] == [{'type': 'error', 'message': 'lip-sync failed'}, {'type': 'done'}]
+
+			await asyncio.sleep(0.1)
+			workers = set(chat.workers)
+			pending = [t for t in asyncio.all_tasks() if t is not asyncio.current_task() and t not in workers]
+			assert pending == []
+		finally:
+			await chat.stop()
+
+	asyncio.run(main())
+
+
+async def collect(turn):
+	return [message async for message in turn.messages()]
@@ -0,0 +1,46 @@
+import os
+import shutil
+import tempfile
+
+# RAM-backed tmpfs, used for the workspaces created with ram=True where available
+RAM_DISK = '/dev/shm'
+
+class Workspace(object):
+	"""Scratch folder of one job (a render, a chat turn, an evaluation run).
+
+	Every workspace is a fresh, uniquely named directory, so jobs running at the same
+	time never share intermediate files such as the extracted audio or the silent AVI.
+	The directory and everything in it is removed by cleanup(), or on leaving the
+	with-block.
+
+	Example::
+
+		with Workspace(ram=True) as job:
+			wavfile.write(job.path('audio.wav'), 16000, wav)
+	"""
+
+	def __init__(self, root='temp', ram=False, prefix='job_'):
+		"""
+		Args:
+			root (str): folder the workspace is created in
+			ram (bool): create the workspace on the RAM disk (/dev/shm) instead of root,
+				if the system has one
+			prefix (str): prefix of the directory name
+		"""
+		if ram and os.path.isdir(RAM_DISK):
+			root = RAM_DISK
+		os.makedirs(root, exist_ok=True)
+		self.dir = tempfile.mkdtemp(prefix=prefix, dir=root)
+
+	def path(self, name):
+		"""Path of the file name inside the workspace"""
+		return os.path.join(self.dir, name)
+
+	def cleanup(self):
+		shutil.rmtree(self.dir, ignore_errors=True)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.cleanup()